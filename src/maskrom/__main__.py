@@ -0,0 +1,180 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+# only argparse and sys are imported up front, the subsystems of a command, including pyusb
+# through defs, are imported when the command runs so that --help starts fast
+import argparse
+import sys
+
+
+def number(text):
+    return int(text, 0)
+
+
+def opendevice(args):
+    from maskrom import defs
+    from maskrom import device
+    from maskrom import usb
+    try:
+        dev = list(usb.iterdevices())[args.device]
+    except IndexError:
+        raise defs.MaskromException(f"no maskrom device with index {args.device}") from None
+    return device.Device(args.device, args.timeout, dev=dev)
+
+
+def cmd_info(args):
+    dev = opendevice(args)
+    for name, query in (("chip", dev.read_chip_info), ("flashid", dev.read_flash_id),
+                        ("flash", dev.read_flash_info), ("capability", dev.read_capability)):
+        print(f"{name}: {query()}")
+
+
+def cmd_load(args):
+    from maskrom import rkboot
+    dev = opendevice(args)
+    with open(args.file, "rb") as f:
+        tag = f.read(4)
+    if tag in rkboot.RKBOOT_TAGS and not args.raw:
+        # the header of an rkboot loader tells whether its entries are encrypted
+        rkboot.boot(dev, args.file, False if args.no_encrypt else None)
+    elif args.dram:
+        dev.load_dram(args.file, not args.no_encrypt)
+    else:
+        dev.load_sram(args.file, not args.no_encrypt)
+
+
+def output(path):
+    return sys.stdout.buffer if path == "-" else open(path, "wb")
+
+
+def cmd_dump(args):
+    from maskrom import defs
+    from maskrom import response
+    dev = opendevice(args)
+    f = output(args.output)
+    try:
+        for resp in defs.Prefetch(dev.iter_lba(args.offset, args.length), dev.queuedepth):
+            f.write(response.checkbuffer(resp))
+    finally:
+        if f is not sys.stdout.buffer:
+            f.close()
+
+
+def cmd_write(args):
+    dev = opendevice(args)
+    with open(args.input, "rb") as f:
+        written = dev.write_lba(args.offset, f)
+    print(f"wrote {written} blocks at {args.offset}")
+
+
+def cmd_erase(args):
+    dev = opendevice(args)
+    for offset, count in dev.erase_lba([(args.offset, args.length)], samples=args.samples):
+        print(f"erased {count} blocks at {offset}")
+
+
+def cmd_ram_read(args):
+    from maskrom import response
+    dev = opendevice(args)
+    f = output(args.output)
+    try:
+        for resp in dev.iter_ram(args.address, args.size):
+            f.write(response.checkbuffer(resp))
+    finally:
+        if f is not sys.stdout.buffer:
+            f.close()
+
+
+def cmd_ram_write(args):
+    dev = opendevice(args)
+    with open(args.input, "rb") as f:
+        written = dev.write_ram(args.address, f, args.execute)
+    print(f"wrote {written} bytes at {args.address:#x}")
+
+
+def cmd_ram_exec(args):
+    opendevice(args).execute(args.address)
+
+
+def parser():
+    main = argparse.ArgumentParser(prog="maskrom", description="Rockchip maskrom and usbplug tool")
+    main.add_argument("-d", "--device", type=int, default=0, help="index of the maskrom device")
+    # defs.DEFAULT_TIMEOUT, defs is not imported for --help
+    main.add_argument("-t", "--timeout", type=int, default=1000, help="usb timeout in ms")
+    commands = main.add_subparsers(dest="command", required=True)
+
+    sub = commands.add_parser("info", help="show chip, flash and capability info")
+    sub.set_defaults(func=cmd_info)
+
+    sub = commands.add_parser("load", help="boot an rkboot loader or load a raw blob to sram or dram")
+    sub.add_argument("file")
+    sub.add_argument("--dram", action="store_true", help="load a raw blob to dram instead of sram")
+    sub.add_argument("--raw", action="store_true", help="load an rkboot loader as a raw blob")
+    sub.add_argument("--no-encrypt", action="store_true", help="do not rc4 encrypt the blob, even when the rkboot header asks for it")
+    sub.set_defaults(func=cmd_load)
+
+    sub = commands.add_parser("dump", help="read lba blocks to a file")
+    sub.add_argument("offset", type=number)
+    sub.add_argument("length", type=number, help="number of blocks")
+    sub.add_argument("output", help="output file, - for stdout")
+    sub.set_defaults(func=cmd_dump)
+
+    sub = commands.add_parser("write", help="write a file to lba blocks")
+    sub.add_argument("offset", type=number)
+    sub.add_argument("input")
+    sub.set_defaults(func=cmd_write)
+
+    sub = commands.add_parser("erase", help="erase lba blocks")
+    sub.add_argument("offset", type=number)
+    sub.add_argument("length", type=number, help="number of blocks")
+    sub.add_argument("-s", "--samples", type=int, default=0, help="skip erase blocks that read back clean, lbas sampled per block before the "
+                     "full read back, slower than erasing unless erases are slow, off by default")
+    sub.set_defaults(func=cmd_erase)
+
+    ram = commands.add_parser("ram", help="read, write and execute ram").add_subparsers(dest="ramcommand",
+                                                                                        required=True)
+    sub = ram.add_parser("read")
+    sub.add_argument("address", type=number)
+    sub.add_argument("size", type=number, help="number of bytes")
+    sub.add_argument("output", help="output file, - for stdout")
+    sub.set_defaults(func=cmd_ram_read)
+    sub = ram.add_parser("write")
+    sub.add_argument("address", type=number)
+    sub.add_argument("input")
+    sub.add_argument("-x", "--execute", action="store_true", help="execute at address after writing")
+    sub.set_defaults(func=cmd_ram_write)
+    sub = ram.add_parser("exec")
+    sub.add_argument("address", type=number)
+    sub.set_defaults(func=cmd_ram_exec)
+    return main
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    try:
+        args.func(args)
+    except Exception as e:
+        from maskrom import defs
+        # pyusb raises OSErrors, and a ValueError when there is no libusb backend
+        if not isinstance(e, (defs.MaskromException, OSError, ValueError)):
+            raise
+        print(f"maskrom: {e}", file=sys.stderr)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
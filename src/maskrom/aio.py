@@ -0,0 +1,144 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import asyncio
+import concurrent.futures
+import functools
+
+from maskrom import defs
+from maskrom import device
+
+MAX_WORKERS = 8
+
+_executor = None
+_end = object()
+
+
+def getexecutor():
+    # all async devices share this pool, it bounds the threads to MAX_WORKERS however many devices
+    # are open. pyusb has no asynchronous transfer api, so a transfer blocks its thread in libusb.
+    # a device runs one request at a time and gives its thread back between requests, so at most
+    # MAX_WORKERS devices transfer at once and the others queue in order for the next free thread
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix="maskrom")
+    return _executor
+
+
+class AsyncDevice:
+    def __init__(self, dev, executor=None):
+        self.device = dev
+        self._executor = executor or getexecutor()
+        self._lock = asyncio.Lock()
+
+    @classmethod
+    async def open(cls, offset=0, timeout=defs.DEFAULT_TIMEOUT, executor=None):
+        executor = executor or getexecutor()
+        dev = await asyncio.get_running_loop().run_in_executor(executor, device.Device, offset, timeout)
+        return cls(dev, executor)
+
+    async def _call(self, func, *args, **kwargs):
+        # the lock is held per request, so other coroutines can slip in between chunks of a bulk transfer
+        async with self._lock:
+            return await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                    functools.partial(func, *args, **kwargs))
+
+    async def _iter(self, iterator):
+        while True:
+            item = await self._call(next, iterator, _end)
+            if item is _end:
+                break
+            yield item
+
+    async def _iterchunks(self, source, size):
+        if hasattr(source, "__aiter__"):
+            pending = bytearray()
+            async for data in source:
+                pending += data
+                while len(pending) >= size:
+                    yield bytes(pending[:size])
+                    del pending[:size]
+            if pending:
+                yield bytes(pending)
+        else:
+            reader = defs.Reader(source)
+            while True:
+                chunk = await asyncio.get_running_loop().run_in_executor(self._executor, reader.read, size)
+                if not chunk:
+                    break
+                yield chunk
+
+    async def _write(self, func, offset, source, unit=defs.BLOCK_SIZE, size=defs.USB_MAX_TRANSFER_SIZE, **kwargs):
+        written = 0
+        async for chunk in self._iterchunks(source, size):
+            written += await self._call(func, offset, chunk, **kwargs)
+            offset += -(-len(chunk) // unit)
+        return written
+
+    async def load_sram(self, path, encrypt=True):
+        return await self._call(self.device.load_sram, path, encrypt)
+
+    async def load_dram(self, path, encrypt=True):
+        return await self._call(self.device.load_dram, path, encrypt)
+
+    async def read_flash_id(self):
+        return await self._call(self.device.read_flash_id)
+
+    async def read_flash_info(self):
+        return await self._call(self.device.read_flash_info)
+
+    async def read_chip_info(self):
+        return await self._call(self.device.read_chip_info)
+
+    async def test_unit_ready(self):
+        return await self._call(self.device.test_unit_ready)
+
+    async def read_capability(self):
+        return await self._call(self.device.read_capability)
+
+    async def device_reset(self, subcode=0):
+        return await self._call(self.device.device_reset, subcode)
+
+    async def read_bad_blocks(self, chipselect=0, cachedir=None, rescan=False):
+        return await self._call(self.device.read_bad_blocks, chipselect, cachedir, rescan)
+
+    async def erase_lba(self, ranges, badblocks=None, samples=0):
+        return await self._call(self.device.erase_lba, ranges, badblocks, samples)
+
+    def iter_lba(self, offset, length, badblocks=None, remap=False):
+        return self._iter(self.device.iter_lba(offset, length, badblocks, remap))
+
+    def iter_spi(self, offset, length):
+        return self._iter(self.device.iter_spi(offset, length))
+
+    def iter_ram(self, offset, size):
+        return self._iter(self.device.iter_ram(offset, size))
+
+    async def write_lba(self, offset, source, badblocks=None, remap=False):
+        return await self._write(self.device.write_lba, offset, source, size=self.device.maxblocks * defs.BLOCK_SIZE,
+                                 badblocks=badblocks, remap=remap)
+
+    async def write_spi(self, offset, source):
+        return await self._write(self.device.write_spi, offset, source)
+
+    async def write_ram(self, offset, source, execute=False):
+        written = await self._write(self.device.write_ram, offset, source, unit=1, size=defs.USB_MAX_SDRAM_SIZE)
+        if execute:
+            await self.execute(offset)
+        return written
+
+    async def execute(self, offset):
+        return await self._call(self.device.execute, offset)
@@ -0,0 +1,137 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import os
+
+from maskrom import defs
+from maskrom import request
+from maskrom import response
+
+_cache = {}
+
+
+class BadBlockMap(defs.Printable):
+    def __init__(self, blocknum, blocksize, bitmap=None):
+        if blocksize <= 0 or blocksize % defs.BLOCK_SIZE:
+            raise defs.MaskromException(f"Block size {blocksize} is not a positive multiple of {defs.BLOCK_SIZE}")
+        self.blocknum = blocknum
+        self.blocksize = defs.PrettyInt(blocksize)
+        self.lbaperblock = int(blocksize // defs.BLOCK_SIZE)
+        self._bitmap = bytearray(bitmap or int((blocknum + 7) / 8))
+
+    def isbad(self, block):
+        if block >= self.blocknum:
+            return False
+        return bool(self._bitmap[block >> 3] & (1 << (block & 7)))
+
+    def setbad(self, block):
+        self._bitmap[block >> 3] |= 1 << (block & 7)
+
+    def update(self, offset, count, buffer):
+        # test_bad_block response is a bitmap, lsb first, relative to the tested offset
+        for index in range(count):
+            if buffer[index >> 3] & (1 << (index & 7)):
+                self.setbad(offset + index)
+
+    @property
+    def badblocks(self):
+        return [block for block in range(self.blocknum) if self.isbad(block)]
+
+    @property
+    def bitmap(self):
+        return bytes(self._bitmap)
+
+    def remap(self, block):
+        # skip bad block strategy, logical block n is the nth good physical block
+        physical = 0
+        for _ in range(block + 1):
+            while self.isbad(physical):
+                physical += 1
+            physical += 1
+        physical -= 1
+        if physical >= self.blocknum:
+            raise defs.LimitsException(f"Logical block {block} is beyond the last good block")
+        return physical
+
+    def _iterblocks(self, offset, length):
+        end = offset + length
+        while offset < end:
+            block = int(offset / self.lbaperblock)
+            blockend = min((block + 1) * self.lbaperblock, end)
+            yield offset, blockend - offset, self.isbad(block)
+            offset = blockend
+
+    def _iterremapped(self, offset, length):
+        end = offset + length
+        block = int(offset / self.lbaperblock)
+        physical = self.remap(block)
+        while offset < end:
+            while self.isbad(physical):
+                physical += 1
+            if physical >= self.blocknum:
+                raise defs.LimitsException(f"Lba range {offset}+{end - offset} is beyond the last good block")
+            blockend = min((block + 1) * self.lbaperblock, end)
+            yield physical * self.lbaperblock + offset % self.lbaperblock, blockend - offset, False
+            offset = blockend
+            block += 1
+            physical += 1
+
+    def iterranges(self, offset, length, remap=False):
+        if remap:
+            return defs.itercoalesce(self._iterremapped(offset, length))
+        return defs.itercoalesce(self._iterblocks(offset, length))
+
+
+def iterranges(badblocks, offset, length, remap=False):
+    if badblocks is None:
+        return iter([(offset, length, False)])
+    return badblocks.iterranges(offset, length, remap)
+
+
+def _cachepath(cachedir, key):
+    return os.path.join(cachedir, hashlib.sha1(repr(key).encode()).hexdigest() + ".bbm")
+
+
+def scan(device, chipselect=0, cachedir=None, rescan=False):
+    flashid = device.read_flash_id()
+    flashinfo = device.read_flash_info()
+    for resp in (flashid, flashinfo):
+        if isinstance(resp, response.Unsupported):
+            raise defs.CommandException(resp.msg)
+    key = (flashid.id, chipselect, flashinfo.blocknum, int(flashinfo.blocksize))
+
+    if not rescan:
+        if key in _cache:
+            return _cache[key]
+        if cachedir and os.path.exists(_cachepath(cachedir, key)):
+            with open(_cachepath(cachedir, key), "rb") as f:
+                _cache[key] = BadBlockMap(flashinfo.blocknum, flashinfo.blocksize, f.read())
+            return _cache[key]
+
+    bbm = BadBlockMap(flashinfo.blocknum, flashinfo.blocksize)
+    for offset, count in defs.iterbatch(bbm.blocknum, defs.USB_MAX_TEST_BLOCKS, 0):
+        resp = device.usb.response(request.test_bad_block, response.Buffer, offset, count, chipselect)
+        if isinstance(resp, response.Unsupported):
+            raise defs.CommandException(resp.msg)
+        bbm.update(offset, count, resp.buffer)
+
+    _cache[key] = bbm
+    if cachedir:
+        os.makedirs(cachedir, exist_ok=True)
+        with open(_cachepath(cachedir, key), "wb") as f:
+            f.write(bbm.bitmap)
+    return bbm
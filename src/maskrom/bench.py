@@ -0,0 +1,362 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import array
+import asyncio
+import ctypes
+import io
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import timeit
+
+from maskrom import aio
+from maskrom import crc
+from maskrom import defs
+from maskrom import device
+from maskrom import erase
+from maskrom import idb
+from maskrom import nbd
+from maskrom import rc4
+from maskrom import request
+from maskrom import response
+from maskrom import sim
+from maskrom import usb
+
+REPEAT = 5
+DEFAULT_THRESHOLD = 0.2
+
+_benchmarks = {}
+
+
+def benchmark(func):
+    _benchmarks[func.__name__] = func
+    return func
+
+
+class Req:
+    # stands in for a parsed response carrying a bulk buffer
+    def __init__(self, buffer, status=0):
+        self.buffer = array.array("B", buffer)
+        self.status = status
+
+
+def startup(*args):
+    # a fresh interpreter running maskrom from this tree
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return lambda: subprocess.run([sys.executable, *args], env=env, stdout=subprocess.DEVNULL, check=True)
+
+
+def idbimage(numentries=4, blocks=8, start=64):
+    builder = idb.Builder()
+    for index in range(numentries):
+        builder.add(bytes([index + 1]) * blocks * defs.BLOCK_SIZE)
+    return bytes(start * defs.BLOCK_SIZE) + builder.tobytes() + bytes(256 * defs.BLOCK_SIZE)
+
+
+@benchmark
+def crc16_64k():
+    buffer = bytes(range(256)) * 256
+    return lambda: crc.crc16(defs.RC4_INITIAL, buffer)
+
+
+@benchmark
+def rc4_crypt_64k():
+    buffer = bytes(range(256)) * 256
+    return lambda: rc4.Rc4(defs.RC4_KEY).crypt(buffer)
+
+
+@benchmark
+def request_read_lba():
+    return lambda: bytes(request.read_lba(0, defs.USB_MAX_BLOCK_COUNT))
+
+
+@benchmark
+def request_write_sdram():
+    return lambda: bytes(request.write_sdram(0, defs.USB_MAX_SDRAM_SIZE))
+
+
+@benchmark
+def request_test_unit_ready():
+    return lambda: bytes(request.test_unit_ready())
+
+
+@benchmark
+def usb_parseresponse():
+    transport = usb.Usb.__new__(usb.Usb)
+    req = request.test_unit_ready()
+    buffer = bytes(response.c_response(sign=response.SIGNATURE, tag=req.tag))
+    return lambda: transport.parseresponse(req, bytearray(buffer))
+
+
+@benchmark
+def iterbatch_64m():
+    length = 64 * 1024 * 1024 // defs.BLOCK_SIZE
+    return lambda: sum(1 for _ in defs.iterbatch(length, defs.USB_MAX_BLOCK_COUNT, 0))
+
+
+@benchmark
+def response_chipinfo():
+    req = Req(b"A883" + b"4202" + b"50" + b"11" + b"00V1")
+    return lambda: response.ChipInfo(req)
+
+
+@benchmark
+def response_flashinfo():
+    req = Req(bytes([0, 0x74, 0, 0, 0, 2, 4, 0, 0, 0, 1]) + bytes(21))
+    return lambda: response.FlashInfo(req)
+
+
+@benchmark
+def response_capability():
+    req = Req(bytes([0xff, 0x1f, 0, 0, 0, 0, 0, 0]))
+    return lambda: response.Capability(req)
+
+
+@benchmark
+def idb_iteridbs():
+    image = idbimage()
+    return lambda: list(idb.iteridbs(io.BytesIO(image)))
+
+
+@benchmark
+def idb_build_256k():
+    blob = bytes(range(256)) * 1024
+    return lambda: idb.Builder().add(blob).add(blob[:1000]).tobytes()
+
+
+@benchmark
+def startup_python():
+    # the interpreter alone, the startup benchmarks below are relative to this
+    return startup("-c", "pass")
+
+
+@benchmark
+def startup_help():
+    return startup("-m", "maskrom", "--help")
+
+
+@benchmark
+def startup_import_device():
+    return startup("-c", "import maskrom.device")
+
+
+@benchmark
+def aio_sim_32_devices():
+    # 32 boards on the modelled link share the bounded pool of aio, the bound is checked on every run
+    host = sim.SimHost()
+    for _ in range(32):
+        host.plug(size=1024 * 1024, timing=True)
+    devices = [device.Device(dev=dev, finder=host.iterdevices) for dev in host.iterdevices()]
+
+    async def read(dev):
+        async for resp in aio.AsyncDevice(dev).iter_lba(0, 512):
+            response.checkbuffer(resp)
+
+    async def readall():
+        await asyncio.gather(*map(read, devices))
+        threads = [thread for thread in threading.enumerate() if thread.name.startswith("maskrom")]
+        if len(threads) > aio.MAX_WORKERS:
+            raise AssertionError(f"{len(threads)} aio threads, the bound is {aio.MAX_WORKERS}")
+    return lambda: asyncio.run(readall())
+
+
+def erasesim(samples):
+    # 4 erase blocks of the modelled link, half of them clean, the plan is checked on every run
+    host = sim.SimHost()
+    host.plug(size=4 * 1024 * 1024, timing=True)
+    storage = host.devices[0].storage
+    dev = device.Device(dev=host.devices[0], finder=host.iterdevices)
+    lbaperblock = storage.blocksize // defs.BLOCK_SIZE
+    expected = [(0, lbaperblock * 4)] if not samples else [(0, lbaperblock), (lbaperblock * 2, lbaperblock)]
+
+    def run():
+        storage.lba[:] = b"\xff" * len(storage.lba)
+        storage.lba[0] = 0
+        storage.lba[(lbaperblock * 3 - 1) * defs.BLOCK_SIZE] = 0
+        commands = erase.plan([(0, lbaperblock * 4)], lbaperblock, device=dev, samples=samples)
+        if commands != expected:
+            raise AssertionError(f"Erase plan is {commands} but expected {expected}")
+        for offset, count in commands:
+            response.checkstatus(dev.usb.response(request.erase_lba, response.Status, offset, count))
+    return run
+
+
+@benchmark
+def erase_sim_blind():
+    return erasesim(0)
+
+
+@benchmark
+def erase_sim_skip():
+    return erasesim(2)
+
+
+def nbdconnect(conn):
+    # the client side of the fixed newstyle handshake, returns the export size
+    greeting = nbd.recvall(conn, 18)
+    if int.from_bytes(greeting[:8], "big") != nbd.NBDMAGIC or not greeting[17] & nbd.FLAG_FIXED_NEWSTYLE:
+        raise AssertionError(f"Unexpected nbd greeting {greeting.hex()}")
+    conn.sendall((nbd.FLAG_FIXED_NEWSTYLE | nbd.FLAG_NO_ZEROES).to_bytes(4, "big"))
+    data = bytes(4) + bytes(2)
+    conn.sendall(bytes(nbd.c_nbdoption(magic=nbd.IHAVEOPT, option=nbd.OPT_GO, length=len(data))) + data)
+    size = None
+    while True:
+        reply = nbd.c_nbdoptionreply.from_buffer(nbd.recvall(conn, ctypes.sizeof(nbd.c_nbdoptionreply)))
+        data = nbd.recvall(conn, reply.length)
+        if reply.type == nbd.REP_ACK:
+            return size
+        if reply.type == nbd.REP_INFO and int.from_bytes(data[:2], "big") == nbd.INFO_EXPORT:
+            size = int.from_bytes(data[2:10], "big")
+
+
+def nbdrequest(conn, cmd, handle, offset=0, length=0, data=b""):
+    conn.sendall(bytes(nbd.c_nbdrequest(magic=nbd.REQUEST_MAGIC, type=cmd, handle=handle, offset=offset,
+                                        length=length)) + data)
+
+
+def nbdreplies(conn, lengths):
+    # {handle: (error, data)} of the replies to the requests in lengths, {handle: read length}
+    replies = {}
+    while len(replies) < len(lengths):
+        reply = nbd.c_nbdreply.from_buffer(nbd.recvall(conn, ctypes.sizeof(nbd.c_nbdreply)))
+        length = lengths[reply.handle] if not reply.error else 0
+        replies[reply.handle] = (reply.error, bytes(nbd.recvall(conn, length)))
+    return replies
+
+
+@benchmark
+def nbd_sim_roundtrip():
+    # an nbd client on a socket pair against the server on a sim device. every run writes single
+    # bytes of one block without waiting between them, so the partial writes race in the pool, then
+    # flushes, reads the bytes back and checks them against the storage of the sim
+    host = sim.SimHost()
+    host.plug(size=4 * 1024 * 1024, timing=True)
+    storage = host.devices[0].storage
+    server = nbd.Server(device.Device(dev=host.devices[0], finder=host.iterdevices))
+    conn, peer = socket.socketpair()
+    threading.Thread(target=server.handle, args=(peer,), daemon=True).start()
+    if nbdconnect(conn) != server.size:
+        raise AssertionError("Nbd export size does not match the device")
+    lines = server.size // server.cache.linesize
+    count = 64
+    runs = iter(range(1 << 30))
+
+    def run():
+        seed = next(runs)
+        # a line off the read ahead of the previous run, so the partial writes miss the cache
+        offset = seed * 37 % lines * server.cache.linesize + 3 * defs.BLOCK_SIZE + 7
+        expected = bytes((seed + index) & 0xff for index in range(count))
+        # the threads switch often so that the merges of the partial writes interleave
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            for index in range(count):
+                nbdrequest(conn, nbd.CMD_WRITE, index, offset + index, 1, expected[index:index + 1])
+            # a flush only covers the writes that were replied to before it was sent
+            replies = nbdreplies(conn, {index: 0 for index in range(count)})
+        finally:
+            sys.setswitchinterval(interval)
+        nbdrequest(conn, nbd.CMD_FLUSH, count)
+        nbdrequest(conn, nbd.CMD_READ, count + 1, offset, count)
+        replies.update(nbdreplies(conn, {count: 0, count + 1: count}))
+        if any(error for error, _data in replies.values()):
+            raise AssertionError(f"Nbd requests failed {replies}")
+        if replies[count + 1][1] != expected or bytes(storage.lba[offset:offset + count]) != expected:
+            raise AssertionError("Nbd partial writes were lost")
+    return run
+
+
+@benchmark
+def nbd_sim_error():
+    # a request that fails with something other than a maskrom exception still gets an EIO reply
+    host = sim.SimHost()
+    host.plug(size=4 * 1024 * 1024)
+    server = nbd.Server(device.Device(dev=host.devices[0], finder=host.iterdevices))
+    server.cache.read = lambda offset, size: 1 / 0
+    conn, peer = socket.socketpair()
+    threading.Thread(target=server.handle, args=(peer,), daemon=True).start()
+    nbdconnect(conn)
+    stderr = sys.stderr
+
+    def run():
+        sys.stderr = io.StringIO()
+        try:
+            nbdrequest(conn, nbd.CMD_READ, 1, 0, defs.BLOCK_SIZE)
+            replies = nbdreplies(conn, {1: defs.BLOCK_SIZE})
+        finally:
+            sys.stderr = stderr
+        if replies[1][0] != nbd.errno.EIO:
+            raise AssertionError(f"Nbd reply to a failed read is {replies[1]}")
+    return run
+
+
+def run(names=None, repeat=REPEAT):
+    results = {}
+    for name, setup in _benchmarks.items():
+        if names and name not in names:
+            continue
+        timer = timeit.Timer(setup())
+        number, _ = timer.autorange()
+        best = min(timer.repeat(repeat, number)) / number
+        results[name] = {"seconds": best, "number": number}
+    return results
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    # returns {name: ratio} of the benchmarks that are slower than baseline beyond threshold
+    regressions = {}
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        ratio = result["seconds"] / baseline[name]["seconds"]
+        if ratio > 1 + threshold:
+            regressions[name] = ratio
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="maskrom.bench", description="Hardware free micro benchmarks")
+    parser.add_argument("names", nargs="*", help=f"benchmarks to run, one of {', '.join(_benchmarks)}")
+    parser.add_argument("-o", "--output", help="write the results as json to this file")
+    parser.add_argument("-b", "--baseline", help="json results to compare against")
+    parser.add_argument("-t", "--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slow down ratio against the baseline")
+    parser.add_argument("-r", "--repeat", type=int, default=REPEAT)
+    args = parser.parse_args(argv)
+
+    results = run(args.names, args.repeat)
+    for name, result in results.items():
+        print(f"{name:<28}{result['seconds'] * 1e6:>14.3f}us")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        for name, ratio in regressions.items():
+            print(f"{name} regressed {ratio:.2f}x", file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
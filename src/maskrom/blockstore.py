@@ -0,0 +1,121 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+from maskrom import defs
+from maskrom import response
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class Manifest(defs.Printable):
+    def __init__(self, name, offset, length, chunksize=CHUNK_SIZE, chunks=None):
+        self.name = name
+        self.offset = offset
+        self.length = length
+        self.chunksize = chunksize
+        self.chunks = chunks or []
+
+    def todict(self):
+        return {"name": self.name, "offset": self.offset, "length": self.length,
+                "chunksize": self.chunksize, "chunks": self.chunks}
+
+
+class Store(defs.Printable):
+    def __init__(self, root):
+        self.root = root
+        self._known = set()
+        os.makedirs(os.path.join(root, "chunks"), exist_ok=True)
+        os.makedirs(os.path.join(root, "manifests"), exist_ok=True)
+
+    def chunkpath(self, digest):
+        return os.path.join(self.root, "chunks", digest[:2], digest[2:])
+
+    def manifestpath(self, name):
+        return os.path.join(self.root, "manifests", name + ".json")
+
+    def has(self, digest):
+        if digest in self._known:
+            return True
+        if os.path.exists(self.chunkpath(digest)):
+            self._known.add(digest)
+            return True
+        return False
+
+    def put(self, buffer):
+        # returns the digest of the chunk and whether the chunk was new to the store
+        digest = hashlib.sha256(buffer).hexdigest()
+        if self.has(digest):
+            return digest, False
+        path = self.chunkpath(digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(buffer)
+        os.replace(tmppath, path)
+        self._known.add(digest)
+        return digest, True
+
+    def get(self, digest):
+        with open(self.chunkpath(digest), "rb") as f:
+            return f.read()
+
+    def savemanifest(self, manifest):
+        with open(self.manifestpath(manifest.name), "w") as f:
+            json.dump(manifest.todict(), f)
+
+    def loadmanifest(self, name):
+        with open(self.manifestpath(name)) as f:
+            return Manifest(**json.load(f))
+
+    def iterchunks(self, manifest):
+        for digest in manifest.chunks:
+            yield self.get(digest)
+
+
+def backup(device, store, name, offset, length, chunksize=CHUNK_SIZE, badblocks=None, remap=False):
+    manifest = Manifest(name, offset, length, chunksize)
+    buffer = bytearray()
+    new = 0
+
+    def put(chunk):
+        digest, isnew = store.put(chunk)
+        manifest.chunks.append(digest)
+        return isnew
+
+    for resp in defs.Prefetch(device.iter_lba(offset, length, badblocks, remap), device.queuedepth):
+        buffer += response.checkbuffer(resp)
+        while len(buffer) >= chunksize:
+            new += put(bytes(buffer[:chunksize]))
+            del buffer[:chunksize]
+    if buffer:
+        new += put(bytes(buffer))
+    store.savemanifest(manifest)
+    return manifest, new
+
+
+def restore(device, store, name, offset=None, badblocks=None, remap=False):
+    manifest = store.loadmanifest(name)
+    offset = manifest.offset if offset is None else offset
+    written = 0
+    for chunk in defs.Prefetch(store.iterchunks(manifest)):
+        written += device.write_lba(offset, chunk, badblocks=badblocks, remap=remap)
+        offset += defs.blockcount(len(chunk))
+    return written
@@ -0,0 +1,252 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import concurrent.futures
+import ctypes
+import hashlib
+import io
+import lzma
+import os
+import zlib
+
+from maskrom import defs
+from maskrom import response
+
+MAGIC = b"RKMZ"
+VERSION = 1
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CHUNK_SIZE = 1024 * 1024
+
+
+class c_header(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("magic", ctypes.c_char * 4),
+        ("version", ctypes.c_uint8),
+        ("codec", ctypes.c_uint8),
+        ("reserved0", ctypes.c_uint8 * 2),
+        ("chunksize", ctypes.c_uint32),
+        ("offset", ctypes.c_uint64),
+        ]
+
+
+class c_chunk(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("offset", ctypes.c_uint64),
+        ("csize", ctypes.c_uint32),
+        ("size", ctypes.c_uint32),
+        ("hash", ctypes.c_uint8 * 32),
+        ]
+
+
+class c_footer(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("index", ctypes.c_uint64),
+        ("numchunks", ctypes.c_uint32),
+        ("magic", ctypes.c_char * 4),
+        ]
+
+
+def compress(buffer, codec, level):
+    digest = hashlib.sha256(buffer).digest()
+    if codec == CODEC_ZLIB:
+        return zlib.compress(buffer, level), len(buffer), digest
+    elif codec == CODEC_LZMA:
+        return lzma.compress(buffer, preset=level), len(buffer), digest
+    return bytes(buffer), len(buffer), digest
+
+
+def decompress(buffer, codec):
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(buffer)
+    elif codec == CODEC_LZMA:
+        return lzma.decompress(buffer)
+    return buffer
+
+
+class Writer:
+    def __init__(self, f, offset=0, codec=CODEC_ZLIB, level=6, chunksize=CHUNK_SIZE, workers=None):
+        if chunksize % defs.BLOCK_SIZE:
+            raise defs.LimitsException(f"Chunk size {chunksize} is not a multiple of {defs.BLOCK_SIZE}")
+        self._f = f
+        self.codec = codec
+        self.level = level
+        self.chunksize = chunksize
+        self.workers = workers or os.cpu_count()
+        self._executor = concurrent.futures.ThreadPoolExecutor(self.workers)
+        self._pending = collections.deque()
+        self._buffer = bytearray()
+        self._index = []
+        self._f.write(c_header(magic=MAGIC, version=VERSION, codec=codec, chunksize=chunksize, offset=offset))
+
+    def _flushone(self):
+        compressed, size, digest = self._pending.popleft().result()
+        chunk = c_chunk(offset=self._f.tell(), csize=len(compressed), size=size)
+        chunk.hash[:] = digest
+        self._index.append(chunk)
+        self._f.write(compressed)
+
+    def _submit(self, buffer):
+        self._pending.append(self._executor.submit(compress, buffer, self.codec, self.level))
+        # bounds the memory, at most 2 chunks per worker are in flight
+        while len(self._pending) > self.workers * 2:
+            self._flushone()
+
+    def write(self, data):
+        self._buffer += data
+        while len(self._buffer) >= self.chunksize:
+            self._submit(bytes(self._buffer[:self.chunksize]))
+            del self._buffer[:self.chunksize]
+
+    def close(self):
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer = bytearray()
+        while self._pending:
+            self._flushone()
+        self._executor.shutdown()
+        index = self._f.tell()
+        for chunk in self._index:
+            self._f.write(chunk)
+        self._f.write(c_footer(index=index, numchunks=len(self._index), magic=MAGIC))
+
+    def abort(self):
+        # drops the pending chunks, without a footer the file does not open as a container
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class Container(defs.Printable):
+    def __init__(self, path, verify=True):
+        self.path = path
+        self.verify = verify
+        self._f = open(path, "rb")
+        header = c_header.from_buffer_copy(self._f.read(ctypes.sizeof(c_header)))
+        if header.magic != MAGIC:
+            raise defs.MaskromException(f"{path} is not a maskrom container")
+        self._f.seek(-ctypes.sizeof(c_footer), os.SEEK_END)
+        footer = c_footer.from_buffer_copy(self._f.read(ctypes.sizeof(c_footer)))
+        if footer.magic != MAGIC:
+            raise defs.MaskromException(f"{path} has no index, the dump is incomplete")
+        self._f.seek(footer.index)
+        self._index = (c_chunk * footer.numchunks).from_buffer_copy(
+            self._f.read(ctypes.sizeof(c_chunk) * footer.numchunks))
+        self.codec = header.codec
+        self.chunksize = header.chunksize
+        self.offset = header.offset
+        self.size = defs.PrettyInt(sum(chunk.size for chunk in self._index))
+        self._cached = (None, None)
+
+    def readchunk(self, index):
+        if self._cached[0] == index:
+            return self._cached[1]
+        chunk = self._index[index]
+        self._f.seek(chunk.offset)
+        buffer = decompress(self._f.read(chunk.csize), self.codec)
+        if self.verify and hashlib.sha256(buffer).digest() != bytes(chunk.hash):
+            raise defs.VerifyException(f"Chunk {index} of {self.path} is corrupted")
+        self._cached = (index, buffer)
+        return buffer
+
+    def read(self, pos, size):
+        # reads size bytes at pos relative to the start of the dump
+        size = max(min(size, self.size - pos), 0)
+        data = bytearray()
+        while len(data) < size:
+            index, start = divmod(pos + len(data), self.chunksize)
+            data += self.readchunk(index)[start:start + size - len(data)]
+        return bytes(data)
+
+    def read_lba(self, offset, length):
+        return self.read((offset - self.offset) * defs.BLOCK_SIZE, length * defs.BLOCK_SIZE)
+
+    def open(self):
+        return Stream(self)
+
+    def close(self):
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Stream(io.RawIOBase):
+    # file like sequential view of a container, ie: to feed Device.write_lba
+    def __init__(self, container):
+        self._container = container
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            pos += self._pos
+        elif whence == os.SEEK_END:
+            pos += self._container.size
+        self._pos = pos
+        return self._pos
+
+    def read(self, size=-1):
+        if size < 0:
+            size = self._container.size - self._pos
+        data = self._container.read(self._pos, size)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+def dump(device, path, offset, length, codec=CODEC_ZLIB, level=6, chunksize=CHUNK_SIZE, workers=None,
+         badblocks=None, remap=False):
+    try:
+        with open(path, "wb") as f:
+            with Writer(f, offset, codec, level, chunksize, workers) as writer:
+                for resp in defs.Prefetch(device.iter_lba(offset, length, badblocks, remap), device.queuedepth):
+                    writer.write(response.checkbuffer(resp))
+    except BaseException:
+        # a partial dump is not left behind to be mistaken for a complete one
+        os.remove(path)
+        raise
+    return Container(path)
@@ -0,0 +1,407 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import array
+import ctypes
+import errno
+import json
+import mmap
+import os
+import socket
+import sys
+import tempfile
+import threading
+import types
+
+from maskrom import defs
+from maskrom import device
+from maskrom import request
+from maskrom import response
+from maskrom import scheduler
+from maskrom import usb
+
+MAGIC = b"RKMD"
+SOCKET_PATH = os.path.join(os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir()), "maskrom.sock")
+# fits the largest lba transfer of any link
+SHM_SIZE = max(blocks for blocks, _depth in defs.LINK_TUNING.values()) * defs.BLOCK_SIZE
+
+OP_ATTACH = 1
+OP_LIST = 2
+OP_DEVICE = 3
+OP_EXCHANGE = 4
+OP_LOAD = 5
+OP_REENUMERATE = 6
+
+FLAG_SRAM = 1 << 0
+FLAG_ENCRYPT = 1 << 1
+FLAG_READY = 1 << 2
+FLAG_USB3 = 1 << 3
+
+
+class c_rpcheader(ctypes.LittleEndianStructure):
+    # requests and replies share the header, bulk data is in the shared memory of the client
+    _pack_ = 1
+    _fields_ = [
+        ("magic", ctypes.c_char * 4),
+        ("op", ctypes.c_uint8),
+        ("flags", ctypes.c_uint8),
+        ("priority", ctypes.c_uint8),
+        ("device", ctypes.c_uint8),
+        ("status", ctypes.c_int32),
+        ("timeout", ctypes.c_uint32),
+        ("length", ctypes.c_uint32),
+        # the CBW of an exchange, the CSW in its reply
+        ("cbw", ctypes.c_uint8 * ctypes.sizeof(request.c_request)),
+        ]
+
+
+HEADER_SIZE = ctypes.sizeof(c_rpcheader)
+
+
+def send(sock, header, fds=()):
+    if fds:
+        socket.send_fds(sock, [bytes(header)], fds)
+    else:
+        sock.sendall(bytes(header))
+
+
+def recv(sock):
+    # returns (header, fds) or (None, []) when the peer is gone
+    data, fds, _flags, _addr = socket.recv_fds(sock, HEADER_SIZE, 1)
+    while data and len(data) < HEADER_SIZE:
+        more = sock.recv(HEADER_SIZE - len(data))
+        if not more:
+            break
+        data += more
+    if len(data) < HEADER_SIZE:
+        for fd in fds:
+            os.close(fd)
+        return None, []
+    header = c_rpcheader.from_buffer_copy(data)
+    if header.magic != MAGIC:
+        raise defs.MaskromException(f"Wrong rpc magic {header.magic}")
+    return header, fds
+
+
+class SharedBuffer:
+    # an anonymous file mapped by both the client and the daemon
+    def __init__(self, size=SHM_SIZE, fd=None):
+        if fd is None:
+            if hasattr(os, "memfd_create"):
+                fd = os.memfd_create("maskrom")
+            else:
+                with tempfile.TemporaryFile() as f:
+                    fd = os.dup(f.fileno())
+            os.ftruncate(fd, size)
+        self.fd = fd
+        self.size = os.fstat(fd).st_size
+        self.map = mmap.mmap(fd, self.size)
+
+    def close(self):
+        self.map.close()
+        os.close(self.fd)
+
+
+def describe(dev, index):
+    path = usb.portpath(dev)
+    return {"index": index, "idVendor": dev.idVendor, "idProduct": dev.idProduct, "bus": path[0],
+            "port_numbers": list(path[1]), "address": dev.address, "speed": getattr(dev, "speed", None)}
+
+
+class Session:
+    def __init__(self, dev):
+        self.device = dev
+        self.scheduler = scheduler.Scheduler(dev)
+
+
+class Server:
+    # holds warm device sessions, every client is served by its own thread and the scheduler of a
+    # session runs the exchanges of all clients in arrival order
+    def __init__(self, path=SOCKET_PATH, timeout=defs.DEFAULT_TIMEOUT, finder=usb.iterdevices,
+                 usb3subcode=defs.RESET_SWITCH_USB3):
+        self.path = path
+        self.timeout = timeout
+        self.finder = finder
+        # the usb3 switch of the clients is only sent when the operator opts in with its subcode
+        self.usb3subcode = usb3subcode
+        self.sessions = {}
+        self._lock = threading.Lock()
+        self._sock = None
+
+    def session(self, index):
+        with self._lock:
+            if index not in self.sessions:
+                self.sessions[index] = Session(device.Device(index, self.timeout, finder=self.finder))
+            return self.sessions[index]
+
+    def _exchange(self, session, header, shm, reply):
+        req = request.c_request.from_buffer_copy(bytes(header.cbw))
+        if req.flag == request.DIRECTION_OUT and req.length:
+            req.buffer = shm.map[:header.length]
+        resp = session.scheduler.call(session.device.usb.request, req, header.timeout or None,
+                                      priority=header.priority)
+        if resp.buffer is not None:
+            reply.length = len(resp.buffer)
+            shm.map[:reply.length] = bytes(resp.buffer)
+        csw = bytes(resp)
+        ctypes.memmove(reply.cbw, csw, len(csw))
+
+    def _reenumerate(self, index, session, header):
+        timeout = header.timeout or defs.REENUMERATION_TIMEOUT
+        if header.flags & FLAG_USB3:
+            dev = session.scheduler.call(session.device.switch_usb3, timeout, subcode=self.usb3subcode,
+                                         priority=header.priority)
+        else:
+            dev = session.scheduler.call(session.device.wait_for_reenumeration, timeout,
+                                         ready=bool(header.flags & FLAG_READY), priority=header.priority)
+        if dev is not session.device:
+            with self._lock:
+                self.sessions[index] = Session(dev)
+            session.scheduler.close()
+        return dev
+
+    def _reply(self, header, shm):
+        reply = c_rpcheader(magic=MAGIC, op=header.op)
+        if header.op == OP_LIST:
+            data = json.dumps([describe(dev, index) for index, dev in enumerate(self.finder())]).encode()
+        elif header.op == OP_DEVICE:
+            data = json.dumps(describe(self.session(header.device).device.usb.dev, header.device)).encode()
+        elif header.op == OP_EXCHANGE:
+            self._exchange(self.session(header.device), header, shm, reply)
+            return reply
+        elif header.op == OP_LOAD:
+            session = self.session(header.device)
+            session.scheduler.call(session.device.usb.loadtoram, bytes(shm.map[:header.length]),
+                                   bool(header.flags & FLAG_SRAM), bool(header.flags & FLAG_ENCRYPT),
+                                   priority=header.priority)
+            return reply
+        elif header.op == OP_REENUMERATE:
+            dev = self._reenumerate(header.device, self.session(header.device), header)
+            data = json.dumps(describe(dev.usb.dev, header.device)).encode()
+        else:
+            raise defs.MaskromException(f"Unknown rpc op {header.op}")
+        reply.length = len(data)
+        shm.map[:len(data)] = data
+        return reply
+
+    def handle(self, conn):
+        shm = None
+        try:
+            while True:
+                header, fds = recv(conn)
+                if header is None:
+                    break
+                if header.op == OP_ATTACH:
+                    if not fds:
+                        send(conn, c_rpcheader(magic=MAGIC, op=OP_ATTACH, status=errno.EINVAL))
+                        continue
+                    if shm:
+                        shm.close()
+                    shm = SharedBuffer(fd=fds[0])
+                    send(conn, c_rpcheader(magic=MAGIC, op=OP_ATTACH, length=shm.size))
+                    continue
+                for fd in fds:
+                    os.close(fd)
+                if shm is None:
+                    # the data and the error messages of the ops go through the shared memory
+                    send(conn, c_rpcheader(magic=MAGIC, op=header.op, status=errno.EINVAL))
+                    continue
+                try:
+                    reply = self._reply(header, shm)
+                except Exception as e:
+                    reply = c_rpcheader(magic=MAGIC, op=header.op, status=getattr(e, "errno", None) or errno.EIO)
+                    message = str(e).encode()[:shm.size]
+                    reply.length = len(message)
+                    shm.map[:len(message)] = message
+                send(conn, reply)
+        finally:
+            if shm:
+                shm.close()
+            conn.close()
+
+    def serve_forever(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.bind(self.path)
+        # only the user of the daemon may drive its devices, nobody can connect before the listen
+        os.chmod(self.path, 0o600)
+        self._sock.listen()
+        try:
+            while True:
+                conn, _addr = self._sock.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        except OSError:
+            # closed by shutdown
+            pass
+
+    def shutdown(self):
+        if self._sock:
+            self._sock.close()
+            os.unlink(self.path)
+        with self._lock:
+            for session in self.sessions.values():
+                session.scheduler.close()
+            self.sessions.clear()
+
+
+class Client:
+    def __init__(self, path=SOCKET_PATH, priority=scheduler.PRIORITY_NORMAL):
+        self.priority = priority
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.shm = None
+        self._lock = threading.RLock()
+        self._attach(SHM_SIZE)
+
+    def _attach(self, size):
+        if self.shm and self.shm.size >= size:
+            return
+        shm = SharedBuffer(size)
+        with self._lock:
+            send(self.sock, c_rpcheader(magic=MAGIC, op=OP_ATTACH, length=size), [shm.fd])
+            reply, _fds = recv(self.sock)
+            if reply is None or reply.status:
+                shm.close()
+                raise defs.CommandException("Daemon refused the shared memory", None,
+                                            reply.status if reply else errno.ECONNRESET)
+            if self.shm:
+                self.shm.close()
+            self.shm = shm
+
+    def _call(self, op, index=0, flags=0, timeout=0, length=0, cbw=None):
+        header = c_rpcheader(magic=MAGIC, op=op, flags=flags, priority=self.priority, device=index,
+                             timeout=timeout, length=length)
+        if cbw:
+            ctypes.memmove(header.cbw, cbw, len(cbw))
+        send(self.sock, header)
+        reply, _fds = recv(self.sock)
+        if reply is None:
+            raise defs.CommandException("Daemon closed the connection", None, errno.ECONNRESET)
+        if reply.status:
+            raise defs.CommandException(bytes(self.shm.map[:reply.length]).decode(errors="replace"),
+                                        None, reply.status)
+        return reply
+
+    def _json(self, op, index=0, flags=0, timeout=0):
+        with self._lock:
+            reply = self._call(op, index, flags, timeout)
+            return json.loads(bytes(self.shm.map[:reply.length]))
+
+    def devices(self):
+        return self._json(OP_LIST)
+
+    def describe(self, index=0):
+        return self._json(OP_DEVICE, index)
+
+    def reenumerate(self, index=0, timeout=defs.REENUMERATION_TIMEOUT, ready=True, usb3=False):
+        flags = (FLAG_READY if ready else 0) | (FLAG_USB3 if usb3 else 0)
+        return self._json(OP_REENUMERATE, index, flags, timeout)
+
+    def exchange(self, index, req, timeout=None):
+        with self._lock:
+            self._attach(req.length)
+            length = 0
+            if req.flag == request.DIRECTION_OUT and req.length:
+                length = len(req.buffer)
+                self.shm.map[:length] = bytes(req.buffer)
+            reply = self._call(OP_EXCHANGE, index, timeout=timeout or 0, length=length, cbw=bytes(req))
+            resp = response.c_response.from_buffer_copy(bytes(reply.cbw)[:ctypes.sizeof(response.c_response)])
+            if reply.length:
+                resp.buffer = array.array("B", self.shm.map[:reply.length])
+            return resp
+
+    def load(self, index, buffer, sram=True, encrypt=True):
+        with self._lock:
+            self._attach(len(buffer))
+            self.shm.map[:len(buffer)] = bytes(buffer)
+            flags = (FLAG_SRAM if sram else 0) | (FLAG_ENCRYPT if encrypt else 0)
+            self._call(OP_LOAD, index, flags, length=len(buffer))
+
+    def open(self, index=0, timeout=defs.DEFAULT_TIMEOUT):
+        return RemoteDevice(self, index, timeout)
+
+    def close(self):
+        self.sock.close()
+        if self.shm:
+            self.shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class RemoteUsb(usb.Usb):
+    # the transport of a device session of the daemon, every exchange is one rpc
+    def __init__(self, client, index=0, timeout=defs.DEFAULT_TIMEOUT):
+        self.client = client
+        self.index = index
+        self.timeout = timeout
+        self.finder = None
+        self.update(client.describe(index))
+
+    def update(self, description):
+        self.dev = types.SimpleNamespace(**description)
+
+    def request(self, req, timeout=None):
+        return self.client.exchange(self.index, req, timeout or self.timeout)
+
+    def loadtoram(self, buffer, sram=True, encrypt=True):
+        return self.client.load(self.index, buffer, sram, encrypt)
+
+
+class RemoteDevice(device.Device):
+    def __init__(self, client, index=0, timeout=defs.DEFAULT_TIMEOUT):
+        self.offset = index
+        self.usb = RemoteUsb(client, index, timeout)
+        self.tune()
+
+    def _follow(self, description):
+        self.usb.update(description)
+        self.tune()
+        return self
+
+    def wait_for_reenumeration(self, timeout=defs.REENUMERATION_TIMEOUT, interval=defs.POLL_INTERVAL, ready=True,
+                               match=None):
+        return self._follow(self.usb.client.reenumerate(self.usb.index, timeout, ready))
+
+    def switch_usb3(self, timeout=defs.REENUMERATION_TIMEOUT, interval=defs.POLL_INTERVAL, subcode=None):
+        # the subcode is the one the server was started with
+        return self._follow(self.usb.client.reenumerate(self.usb.index, timeout, usb3=True))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="maskrom.daemon", description="Shares maskrom devices over a unix socket")
+    parser.add_argument("-s", "--socket", default=SOCKET_PATH)
+    parser.add_argument("-t", "--timeout", type=int, default=defs.DEFAULT_TIMEOUT)
+    parser.add_argument("--usb3-subcode", type=lambda text: int(text, 0), default=defs.RESET_SWITCH_USB3,
+                        help="device_reset subcode of the usb3 switch, the switch is refused without it")
+    args = parser.parse_args(argv)
+    server = Server(args.socket, args.timeout, usb3subcode=args.usb3_subcode)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.shutdown()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -16,16 +16,45 @@
 """
 import usb.core
 import math
+import os
+import queue
+import threading
 
 RKBINREPO = "https://github.com/rockchip-linux/rkbin"
 DEFAULT_TIMEOUT = 1000
+ERASE_TIMEOUT = 30000
+PROBE_TIMEOUT = 100
+REENUMERATION_TIMEOUT = 5000
+POLL_INTERVAL = 0.02
 BLOCK_SIZE = 512
 USB_MAX_BLOCK_COUNT = 128
 USB_MAX_SECTOR_COUNT = 32
+USB_MAX_TEST_BLOCKS = 512
+USB_MAX_ERASE_COUNT = 0xffff
 USB_MAX_TRANSFER_SIZE = BLOCK_SIZE * USB_MAX_BLOCK_COUNT
 RC4_KEY = bytes([124, 78, 3, 4, 85, 5, 9, 7, 45, 44, 123, 56, 23, 13, 23, 17])
 RC4_INITIAL = 0xffff
 USB_TRANSFER_ALIGN = 4096
+# sdram requests carry the size in the 16 bit length field of the op
+USB_MAX_SDRAM_SIZE = USB_MAX_TRANSFER_SIZE - USB_TRANSFER_ALIGN
+# link speeds as reported by libusb
+USB_SPEED_HIGH = 3
+USB_SPEED_SUPER = 4
+# (blocks per lba request, prefetch queue depth) per link speed. super speed keeps the high speed
+# values until python -m maskrom.profiler --usb3-subcode measures better ones on a board, the --sim
+# runs only replay the link model of the sim and can not tell
+LINK_TUNING = {USB_SPEED_HIGH: (USB_MAX_BLOCK_COUNT, 4),
+               USB_SPEED_SUPER: (USB_MAX_BLOCK_COUNT, 4)}
+
+# device_reset subcodes, reference: rkdeveloptool
+RESET_REBOOT = 0
+RESET_MSC = 1
+RESET_POWEROFF = 2
+RESET_MASKROM = 3
+RESET_DISCONNECT = 4
+# loaders announce a usb3 switch with Capability.switch_usb3, but the subcode that triggers it is
+# not confirmed on real boards, so it stays unset and callers have to opt in with a subcode
+RESET_SWITCH_USB3 = None
 
 MANUFACTURER_SAMSUNG = "samsung"
 MANUFACTURER_TOSHIBA = "toshiba"
@@ -39,10 +68,13 @@ MANUFACTURER_ROCKCHIP = "rockchip"
 UNKNOWN = "unknown"
 UNSUPPORTED = "unsupprted"
 
+DEVICE_RK1106 = "rk1106"
+DEVICE_RK1808 = "rk1808"
 DEVICE_RK2818 = "rk2818"
 DEVICE_RK2918 = "rk2918"
 DEVICE_RK2928 = "rk2928"
 DEVICE_RK3026 = "rk3026"
+DEVICE_RK3032 = "rk3032"
 DEVICE_RK3036 = "rk3036"
 DEVICE_RK3066 = "rk3066"
 DEVICE_RK3066B = "rk3066b"
@@ -97,7 +129,9 @@ FLASH_MANUFACTURERS = {0: MANUFACTURER_SAMSUNG,
 
 RK_VENDOR_ID = 0x2207
 MASKROM_VENDOR_IDS = [0x2207, 0x071b, 0x0bb4]
-MASKROM_PRODUCT_IDS = {0x281a: DEVICE_RK2818,
+MASKROM_PRODUCT_IDS = {0x110c: DEVICE_RK1106,
+                       0x1808: DEVICE_RK1808,
+                       0x281a: DEVICE_RK2818,
                        0x290a: DEVICE_RK2918,
                        0x292a: DEVICE_RK2928,
                        0x292c: DEVICE_RK3026,
@@ -161,6 +195,10 @@ class IdbException(MaskromException):
     pass
 
 
+class VerifyException(MaskromException):
+    pass
+
+
 class CommandException(MaskromException, usb.core.USBError):
     def __init__(self, strerror, error_code=None, errno=None):
         super().__init__(strerror, error_code, errno)
@@ -197,4 +235,154 @@ def iterbatch(length, size, offset):
         yield offset, size
         offset += size
     if length > factor * size:
-        yield offset, length - offset
+        yield offset, length - factor * size
+
+
+def itercoalesce(ranges):
+    # merges contiguous (offset, length, *tags) ranges having the same tags
+    current = None
+    for offset, length, *tags in ranges:
+        if current and current[0] + current[1] == offset and current[2:] == tags:
+            current[1] += length
+            continue
+        if current:
+            yield tuple(current)
+        current = [offset, length, *tags]
+    if current:
+        yield tuple(current)
+
+
+def blockcount(size):
+    return -(-size // BLOCK_SIZE)
+
+
+class Reader:
+    # uniform sequential reads over bytes-like objects, mmaps and file objects
+    def __init__(self, source):
+        self._pos = 0
+        try:
+            self._view = memoryview(source).cast("B")
+            self._file = None
+            self.size = len(self._view)
+        except TypeError:
+            self._view = None
+            self._file = source
+            try:
+                pos = source.tell()
+                self.size = source.seek(0, os.SEEK_END) - pos
+                source.seek(pos)
+            except (AttributeError, OSError, ValueError):
+                self.size = None
+
+    def read(self, size):
+        if self._file is not None:
+            return self._file.read(size)
+        chunk = self._view[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk
+
+    def iterchunks(self, size):
+        while True:
+            chunk = self.read(size)
+            if not chunk:
+                break
+            yield chunk
+
+
+class Prefetch:
+    # runs an iterator in a background thread, so that usb transfers and
+    # file io or hashing of the consumer overlap
+    _end = object()
+
+    def __init__(self, iterable, depth=4):
+        self._queue = queue.Queue(depth)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(iter(iterable),), daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, iterator):
+        try:
+            for item in iterator:
+                if not self._put((item, None)):
+                    return
+            self._put((self._end, None))
+        except Exception as e:
+            self._put((self._end, e))
+
+    def __iter__(self):
+        try:
+            while True:
+                item, error = self._queue.get()
+                if item is self._end:
+                    if error:
+                        raise error
+                    break
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stop.set()
+
+
+class Fanout:
+    # feeds every buffer to each sink on its own thread, sinks are objects with write() and optionally close()
+    _end = object()
+
+    def __init__(self, sinks, depth=4):
+        self._errors = []
+        self._queues = []
+        self._threads = []
+        for sink in sinks:
+            q = queue.Queue(depth)
+            thread = threading.Thread(target=self._run, args=(sink, q), daemon=True)
+            thread.start()
+            self._queues.append(q)
+            self._threads.append(thread)
+
+    def _run(self, sink, q):
+        while True:
+            buffer = q.get()
+            if buffer is self._end:
+                break
+            if self._errors:
+                continue
+            try:
+                sink.write(buffer)
+            except Exception as e:
+                self._errors.append(e)
+        if hasattr(sink, "close"):
+            try:
+                sink.close()
+            except Exception as e:
+                self._errors.append(e)
+
+    def write(self, buffer):
+        if self._errors:
+            raise self._errors[0]
+        buffer = bytes(buffer)
+        for q in self._queues:
+            q.put(buffer)
+
+    def close(self):
+        for q in self._queues:
+            q.put(self._end)
+        for thread in self._threads:
+            thread.join()
+        if self._errors:
+            raise self._errors[0]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -15,8 +15,11 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import itertools
+import os
+import time
 
+from maskrom import badblock
+from maskrom import erase
 from maskrom import request
 from maskrom import response
 from maskrom import usb
@@ -24,8 +27,57 @@ from maskrom import defs
 
 
 class Device:
-    def __init__(self, offset=0, timeout=defs.DEFAULT_TIMEOUT):
-        self.usb = usb.Usb(offset, timeout)
+    def __init__(self, offset=0, timeout=defs.DEFAULT_TIMEOUT, dev=None, finder=usb.iterdevices):
+        self.offset = offset
+        self.usb = usb.Usb(offset, timeout, dev, finder)
+        self.tune()
+
+    def tune(self):
+        # transfer sizes and queue depth follow the negotiated link speed
+        speed = getattr(self.usb.dev, "speed", None) or defs.USB_SPEED_HIGH
+        self.speed = defs.USB_SPEED_SUPER if speed >= defs.USB_SPEED_SUPER else defs.USB_SPEED_HIGH
+        self.maxblocks, self.queuedepth = defs.LINK_TUNING[self.speed]
+
+    def wait_ready(self, timeout=defs.REENUMERATION_TIMEOUT, interval=defs.POLL_INTERVAL):
+        deadline = time.monotonic() + timeout / 1000
+        resptimeout, self.usb.timeout = self.usb.timeout, defs.PROBE_TIMEOUT
+        try:
+            while True:
+                status = self.test_unit_ready()
+                if isinstance(status, response.Status) and status.status:
+                    return self
+                if time.monotonic() > deadline:
+                    raise defs.CommandException(f"Device is not ready in {timeout}ms")
+                time.sleep(interval)
+        finally:
+            self.usb.timeout = resptimeout
+
+    def wait_for_reenumeration(self, timeout=defs.REENUMERATION_TIMEOUT, interval=defs.POLL_INTERVAL, ready=True,
+                               match=None):
+        # after a reset or a loader upload, follows the same usb port and returns a session to the new device
+        start = time.monotonic()
+        found = usb.wait_for_reenumeration(self.usb.dev, timeout, interval, match, self.usb.finder)
+        dev = usb.settle(lambda: Device(self.offset, self.usb.timeout, found, self.usb.finder),
+                         max(timeout - (time.monotonic() - start) * 1000, 0), interval)
+        if ready:
+            dev.wait_ready(max(timeout - (time.monotonic() - start) * 1000, 0), interval)
+        return dev
+
+    def switch_usb3(self, timeout=defs.REENUMERATION_TIMEOUT, interval=defs.POLL_INTERVAL,
+                    subcode=defs.RESET_SWITCH_USB3):
+        # returns a session on the superspeed link, or self when the link or the loader can not switch
+        if self.speed >= defs.USB_SPEED_SUPER:
+            return self
+        if subcode is None:
+            raise defs.CommandException("The device_reset subcode of the usb3 switch is not confirmed, "
+                                        "it has to be given explicitly")
+        capability = self.read_capability()
+        if not isinstance(capability, response.Capability) or not capability.switch_usb3:
+            return self
+        match = usb.superspeedmatch(self.usb.dev, self.usb.finder)
+        # the device may drop off the bus before the status is sent
+        self.device_reset(subcode)
+        return self.wait_for_reenumeration(timeout, interval, match=match)
 
     def flush(self):
         try:
@@ -33,11 +85,17 @@ class Device:
         except defs.MaskromException:
             pass
 
-    def load_sram(self, path, encrypt=True):
-        return self.usb.loadfiletoram(path, True, encrypt)
+    def _load(self, source, sram, encrypt):
+        # source is either a path or a bytes like object, ie: a memoryview of a firmware package
+        if isinstance(source, (str, os.PathLike)):
+            return self.usb.loadfiletoram(source, sram, encrypt)
+        return self.usb.loadtoram(source, sram, encrypt)
+
+    def load_sram(self, source, encrypt=True):
+        return self._load(source, True, encrypt)
 
-    def load_dram(self, path, encrypt=True):
-        return self.usb.loadfiletoram(path, False, encrypt)
+    def load_dram(self, source, encrypt=True):
+        return self._load(source, False, encrypt)
 
     def read_flash_id(self):
         # TODO: emmc: 0x434d4d45: EMMC
@@ -58,18 +116,85 @@ class Device:
     def device_reset(self, subcode=0):
         return self.usb.response(request.device_reset, response.Status, subcode)
 
-    def iter_lba(self, offset, length):
+    def read_bad_blocks(self, chipselect=0, cachedir=None, rescan=False):
+        return badblock.scan(self, chipselect, cachedir, rescan)
+
+    def iter_lba(self, offset, length, badblocks=None, remap=False):
+        for offset, length, bad in badblock.iterranges(badblocks, offset, length, remap):
+            for offset, size in defs.iterbatch(length, self.maxblocks, offset):
+                if bad:
+                    yield response.Blank(size * defs.BLOCK_SIZE)
+                else:
+                    yield self.usb.response(request.read_lba, response.Buffer, offset, size)
+
+    def _write(self, request_ob, offset, source, length=None, badblocks=None, remap=False,
+               maxblocks=defs.USB_MAX_BLOCK_COUNT):
+        reader = defs.Reader(source)
+        if length is None:
+            length = defs.blockcount(reader.size)
+        written = 0
+        for offset, length, bad in badblock.iterranges(badblocks, offset, length, remap):
+            for offset, size in defs.iterbatch(length, maxblocks, offset):
+                buffer = reader.read(size * defs.BLOCK_SIZE)
+                if not buffer:
+                    return written
+                if bad:
+                    continue
+                size = defs.blockcount(len(buffer))
+                if len(buffer) < size * defs.BLOCK_SIZE:
+                    buffer = bytes(buffer) + bytes(size * defs.BLOCK_SIZE - len(buffer))
+                response.checkstatus(self.usb.response(request_ob, response.Status, offset, size,
+                                                       buffer=buffer))
+                written += size
+        return written
+
+    def write_lba(self, offset, source, length=None, badblocks=None, remap=False):
+        return self._write(request.write_lba, offset, source, length, badblocks, remap, self.maxblocks)
+
+    def erase_lba(self, ranges, badblocks=None, samples=0):
+        if badblocks:
+            lbaperblock = badblocks.lbaperblock
+        else:
+            flashinfo = self.read_flash_info()
+            if isinstance(flashinfo, response.Unsupported):
+                raise defs.CommandException(flashinfo.msg)
+            lbaperblock = int(flashinfo.blocksize / defs.BLOCK_SIZE)
+        commands = erase.plan(ranges, lbaperblock, badblocks, self, samples)
+        for offset, count in commands:
+            response.checkstatus(self.usb.response(request.erase_lba, response.Status, offset, count,
+                                                   timeout=defs.ERASE_TIMEOUT))
+        return commands
+
+    def iter_spi(self, offset, length):
         for offset, size in defs.iterbatch(length, defs.USB_MAX_BLOCK_COUNT, offset):
-            yield self.usb.response(request.read_lba, response.Buffer, offset, size)
+            yield self.usb.response(request.read_spi_flash, response.Buffer, offset, size)
+
+    def write_spi(self, offset, source, length=None):
+        return self._write(request.write_spi_flash, offset, source, length)
 
     def iter_sector(self, offset, length):
         for offset, size in defs.iterbatch(length, defs.USB_MAX_SECTOR_COUNT, offset):
             yield self.usb.response(request.read_sector, response.Buffer, offset, size)
 
     def iter_ram(self, offset, size):
-        for offset, size in defs.iterbatch(size, defs.USB_MAX_TRANSFER_SIZE, offset):
+        for offset, size in defs.iterbatch(size, defs.USB_MAX_SDRAM_SIZE, offset):
             yield self.usb.response(request.read_sdram, response.Buffer, offset, size)
 
-    # def write_ram(self, offset, buffer):
-    #     for chunk in itertools.batched(buffer, defs.USB_MAX_TRANSFER_SIZE):
-    #        yield self.usb.response(request.write_sdram, bytes, offset, size)
+    def write_ram(self, offset, source, execute=False):
+        # rockusb is a bulk only transport, the status of a chunk is read before the next command is
+        # sent, so the status checks can not overlap the data and only the file io is overlapped
+        chunks = defs.Reader(source).iterchunks(defs.USB_MAX_SDRAM_SIZE)
+        if hasattr(source, "read"):
+            # files are read ahead in the background while the previous chunk is on the bus
+            chunks = defs.Prefetch(chunks, self.queuedepth)
+        written = 0
+        for buffer in chunks:
+            response.checkstatus(self.usb.response(request.write_sdram, response.Status, offset + written,
+                                                   len(buffer), buffer=buffer))
+            written += len(buffer)
+        if execute:
+            self.execute(offset)
+        return written
+
+    def execute(self, offset):
+        return response.checkstatus(self.usb.response(request.execute_sdram, response.Status, offset))
@@ -0,0 +1,101 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+from maskrom import badblock
+from maskrom import defs
+from maskrom import request
+from maskrom import response
+
+ERASED_PATTERNS = (0x00, 0xff)
+
+
+def merge(ranges):
+    # sorts and merges overlapping or adjacent (offset, length) ranges
+    merged = []
+    for offset, length in sorted(ranges):
+        if merged and offset <= merged[-1][0] + merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], offset + length - merged[-1][0])
+        elif length:
+            merged.append([offset, length])
+    return [tuple(x) for x in merged]
+
+
+def align(ranges, lbaperblock):
+    # erase works on whole blocks, so partial blocks are extended to block boundaries
+    for offset, length in ranges:
+        start = offset - offset % lbaperblock
+        end = -(-(offset + length) // lbaperblock) * lbaperblock
+        yield start, end - start
+
+
+def iserased(buffer):
+    buffer = bytes(buffer)
+    return bool(buffer) and buffer[0] in ERASED_PATTERNS and buffer.count(buffer[0]) == len(buffer)
+
+
+def maxcount(lbaperblock):
+    if lbaperblock > defs.USB_MAX_ERASE_COUNT:
+        return defs.USB_MAX_ERASE_COUNT
+    return int(defs.USB_MAX_ERASE_COUNT / lbaperblock) * lbaperblock
+
+
+def samplelbas(block, blocklength, samples):
+    # spread evenly over the block, the first and the last lba are always sampled
+    last = blocklength - 1
+    return sorted({block + last * index // max(samples - 1, 1) for index in range(samples)} | {block + last})
+
+
+def isblockerased(device, block, blocklength):
+    pattern = None
+    for resp in device.iter_lba(block, blocklength):
+        if isinstance(resp, response.Unsupported) or not iserased(resp.buffer):
+            return False
+        if pattern is None:
+            pattern = resp.buffer[0]
+        elif resp.buffer[0] != pattern:
+            return False
+    return True
+
+
+def iterdirty(device, ranges, lbaperblock, samples=1):
+    # drops the blocks which read back as erased. the sampled lbas only find the dirty blocks early,
+    # a block is dropped after the whole of it is read back, so data between the samples is not lost.
+    # an erase is a single command per block, so the read back of the clean blocks is slower than
+    # erasing them, the skip only pays off where erases are slow or wear the flash
+    for offset, length in ranges:
+        for block, blocklength in defs.iterbatch(length, lbaperblock, offset):
+            erased = True
+            for lba in samplelbas(block, blocklength, samples):
+                resp = device.usb.response(request.read_lba, response.Buffer, lba, 1)
+                if isinstance(resp, response.Unsupported) or not iserased(resp.buffer):
+                    erased = False
+                    break
+            if not erased or not isblockerased(device, block, blocklength):
+                yield block, blocklength
+
+
+def plan(ranges, lbaperblock, badblocks=None, device=None, samples=0):
+    # the skip of clean blocks is off by default, samples > 0 turns it on, see iterdirty
+    ranges = merge(align(merge(ranges), lbaperblock))
+    if badblocks:
+        ranges = [(offset, length) for r in ranges
+                  for offset, length, bad in badblock.iterranges(badblocks, *r) if not bad]
+    if device and samples:
+        ranges = merge(iterdirty(device, ranges, lbaperblock, samples))
+    commands = []
+    for offset, length in ranges:
+        commands.extend(defs.iterbatch(length, maxcount(lbaperblock), offset))
+    return commands
@@ -15,13 +15,31 @@
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
+import concurrent.futures
 import ctypes
 import hashlib
+import mmap
 import operator
+import os
 from maskrom import defs
+from maskrom import response
 
 IDBHASH = [None, hashlib.sha256, hashlib.sha512]
+IDBHASH_SHA256 = 1
+IDBHASH_SHA512 = 2
 IDBV2_MAGIC = b"RKNS"
+IDBV2_MAX_ENTRIES = 4
+# value of the header offset field, reference: u-boot rkcommon
+IDBV2_HEADER_SIZE = 384
+IDB_NO_ADDRESS = 0xffffffff
+# first block of the idb on storage
+IDB_LBA = 64
+# redundant copies, reference: rkdeveloptool
+IDB_COPY_STRIDE = 1024
+IDB_MAX_COPIES = 5
+MAX_WORKERS = 4
+
+_executor = None
 
 
 class c_idbentry_v2(ctypes.Structure):
@@ -52,6 +70,13 @@ class c_idbheader_v2(ctypes.Structure):
         ]
 
 
+def getexecutor():
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(MAX_WORKERS, thread_name_prefix="idb")
+    return _executor
+
+
 def hashblock(buffer, hashtype, given=None):
     if not hashtype < len(IDBHASH):
         # signed?
@@ -99,6 +124,24 @@ class IdBlock(defs.Printable):
         self.entries = [IdEntry(x) for x in self._idb.entries if x.counter]
         self.entries.sort(key=operator.attrgetter("counter"))
 
+    @property
+    def counter(self):
+        return max((entry.counter for entry in self.entries), default=0)
+
+    def fetch(self, device, lba):
+        # reads only the entry blocks of a header at lba of a live device, adjacent entries in one run
+        self.block = lba
+        runs = []
+        for start, count in defs.itercoalesce(sorted((lba + e.offset, e.blocks) for e in self.entries)):
+            buffer = b"".join(bytes(response.checkbuffer(resp)) for resp in device.iter_lba(start, count))
+            runs.append((start, buffer))
+        for entry in self.entries:
+            start = lba + entry.offset
+            runstart, buffer = next(run for run in reversed(runs) if run[0] <= start)
+            pos = (start - runstart) * defs.BLOCK_SIZE
+            entry._blob = buffer[pos:pos + entry.blocks * defs.BLOCK_SIZE]
+            entry.hash = hashblock(entry._blob, self.hashtype, bytes(entry.hash))
+
     def read(self, f):
         self.block = int((f.tell() - ctypes.sizeof(c_idbheader_v2)) / defs.BLOCK_SIZE)
         for entry in self.entries:
@@ -120,3 +163,120 @@ def iteridbs(f):
                 yield idblock
             except defs.IdbException:
                 continue
+
+
+def candidates(lba=IDB_LBA, copies=IDB_MAX_COPIES, stride=IDB_COPY_STRIDE):
+    return [lba + copy * stride for copy in range(copies)]
+
+
+def locate(device, lbas=None):
+    # probes only the header blocks of the candidate lbas in a pipelined batch, then fetches the
+    # entries of the valid copy with the highest counter, returns None when there is no valid idb
+    lbas = candidates() if lbas is None else lbas
+    headerblocks = int(ctypes.sizeof(c_idbheader_v2) / defs.BLOCK_SIZE)
+
+    def iterheaders():
+        for lba in lbas:
+            for resp in device.iter_lba(lba, headerblocks):
+                yield lba, resp
+
+    found = []
+    for lba, resp in defs.Prefetch(iterheaders(), device.queuedepth):
+        if not isinstance(resp, response.Buffer) or resp.buffer is None:
+            continue
+        header = bytes(resp.buffer)
+        if not IdBlock.checkmagic(header):
+            continue
+        try:
+            idblock = IdBlock(header)
+        except defs.IdbException:
+            continue
+        found.append((lba, idblock))
+
+    for lba, idblock in sorted(found, key=lambda item: (-item[1].counter, item[0])):
+        try:
+            idblock.fetch(device, lba)
+            return idblock
+        except (defs.IdbException, defs.CommandException):
+            # a torn or unreadable copy, try the next one
+            continue
+    return None
+
+
+class Builder:
+    # lays out an idbv2 of up to 4 entries, each entry starts at the next block after the previous one
+    def __init__(self, hashtype=IDBHASH_SHA256):
+        if hashtype not in (IDBHASH_SHA256, IDBHASH_SHA512):
+            raise defs.IdbException(f"Unknown hash type {hashtype}")
+        self.hashtype = hashtype
+        self.entries = []
+
+    def add(self, blob, address=IDB_NO_ADDRESS, flag=0, counter=None):
+        # counter defaults to the 1 based index of the entry
+        if len(self.entries) >= IDBV2_MAX_ENTRIES:
+            raise defs.IdbException(f"Idb can have at most {IDBV2_MAX_ENTRIES} entries")
+        counter = len(self.entries) + 1 if counter is None else counter
+        self.entries.append((memoryview(blob).cast("B"), address, flag, counter))
+        return self
+
+    @property
+    def blocks(self):
+        headerblocks = int(ctypes.sizeof(c_idbheader_v2) / defs.BLOCK_SIZE)
+        return headerblocks + sum(defs.blockcount(len(blob)) for blob, _address, _flag, _counter in self.entries)
+
+    @property
+    def size(self):
+        return self.blocks * defs.BLOCK_SIZE
+
+    def _hashentry(self, blob):
+        # entries are hashed with the zero padding of their last block
+        m = IDBHASH[self.hashtype]()
+        m.update(blob)
+        m.update(bytes(-len(blob) % defs.BLOCK_SIZE))
+        return m.digest()
+
+    def render(self, out, pos=0):
+        # writes one copy into the writable buffer out at byte pos, entries are hashed in parallel
+        digests = getexecutor().map(self._hashentry, [blob for blob, _address, _flag, _counter in self.entries])
+        header = c_idbheader_v2(magic=IDBV2_MAGIC, offset=IDBV2_HEADER_SIZE, numentries=len(self.entries),
+                                flags=self.hashtype)
+        offset = int(ctypes.sizeof(c_idbheader_v2) / defs.BLOCK_SIZE)
+        for index, ((blob, address, flag, counter), digest) in enumerate(zip(self.entries, digests)):
+            blocks = defs.blockcount(len(blob))
+            entry = header.entries[index]
+            entry.offset = offset
+            entry.blocks = blocks
+            entry.address = address
+            entry.flag = flag
+            entry.counter = counter
+            ctypes.memmove(entry.hash, digest, len(digest))
+            start = pos + offset * defs.BLOCK_SIZE
+            out[start:start + len(blob)] = blob
+            out[start + len(blob):start + blocks * defs.BLOCK_SIZE] = bytes(-len(blob) % defs.BLOCK_SIZE)
+            offset += blocks
+        digest = hashblock(bytes(header)[:-ctypes.sizeof(header.signature)], self.hashtype)
+        ctypes.memmove(header.signature, digest, len(digest))
+        out[pos:pos + ctypes.sizeof(header)] = bytes(header)
+        return header
+
+    def tobytes(self):
+        out = bytearray(self.size)
+        self.render(out)
+        return bytes(out)
+
+    def write(self, path, lba=0, copies=1, stride=IDB_COPY_STRIDE):
+        # writes the idb and its redundant copies into an mmap of the image at path, the image is
+        # created or grown as needed, returns the lbas of the copies
+        if copies > 1 and self.blocks > stride:
+            raise defs.IdbException(f"Idb of {self.blocks} blocks does not fit the copy stride of {stride}")
+        lbas = [lba + copy * stride for copy in range(copies)]
+        end = (lbas[-1] + self.blocks) * defs.BLOCK_SIZE
+        with open(path, "r+b" if os.path.exists(path) else "w+b") as f:
+            if os.fstat(f.fileno()).st_size < end:
+                f.truncate(end)
+            with mmap.mmap(f.fileno(), 0) as mm:
+                first = lbas[0] * defs.BLOCK_SIZE
+                self.render(mm, first)
+                for copy in lbas[1:]:
+                    mm.move(copy * defs.BLOCK_SIZE, first, self.size)
+        return lbas
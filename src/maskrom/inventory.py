@@ -0,0 +1,202 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import concurrent.futures
+import csv
+import ctypes
+import hashlib
+import json
+import os
+import sys
+import time
+
+from maskrom import defs
+from maskrom import device
+from maskrom import idb
+from maskrom import request
+from maskrom import response
+from maskrom import usb
+
+MAX_WORKERS = 8
+PROBE_TIMEOUT = 5000
+CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "maskrom",
+                          "inventory.json")
+COLUMNS = ("path", "serial", "idVendor", "idProduct", "speed", "chip.tag", "chip.date", "chip.revision",
+           "chip.socid", "flashid", "flash.flashsize", "flash.blocksize", "flash.blocknum", "flash.pagesize",
+           "flash.manufacturername", "flash.chipselect", "capability", "idb.numentries", "idb.counters",
+           "idb.digest", "cached", "error")
+
+
+def pathname(dev):
+    # sysfs style bus path, ie: 1-1.4
+    bus, ports = usb.portpath(dev)
+    return f"{bus}-{'.'.join(str(port) for port in ports) or 0}"
+
+
+def serial(dev):
+    try:
+        return dev.serial_number
+    except (AttributeError, NotImplementedError, ValueError, IOError):
+        return None
+
+
+def cachekey(path, serialnumber):
+    # a board swapped on the same port has another serial, boards without one are told apart by
+    # the chip info query which confirms every cached record
+    return f"{path}/{serialnumber or ''}"
+
+
+def chipinfo(resp):
+    if isinstance(resp, response.Unsupported):
+        return None
+    return {"tag": resp.tag, "date": str(resp.date), "revision": resp.revision, "socid": resp.socid}
+
+
+def flashinfo(resp):
+    if isinstance(resp, response.Unsupported):
+        return None
+    return {"flashsize": int(resp.flashsize), "blocksize": int(resp.blocksize), "blocknum": resp.blocknum,
+            "pagesize": int(resp.pagesize), "manufacturername": resp.manufacturername,
+            "chipselect": resp.chipselect}
+
+
+def capability(resp):
+    if not isinstance(resp, response.Capability):
+        return None
+    return sorted(k for k, v in vars(resp).items() if v is True)
+
+
+def idbinfo(dev, timeout=None):
+    resp = dev.usb.response(request.read_lba, response.Buffer, idb.IDB_LBA,
+                            defs.blockcount(ctypes.sizeof(idb.c_idbheader_v2)), timeout=timeout)
+    header = bytes(response.checkbuffer(resp))
+    if not idb.IdBlock.checkmagic(header):
+        return None
+    try:
+        idblock = idb.IdBlock(header)
+    except defs.IdbException as e:
+        return {"error": str(e)}
+    return {"numentries": idblock.numentries, "counters": [entry.counter for entry in idblock.entries],
+            "digest": hashlib.sha256(header).hexdigest()}
+
+
+def probe(dev, timeout=PROBE_TIMEOUT, cache=None):
+    # probes a single usb device, a cached record is confirmed with one chip info query
+    deadline = time.monotonic() + timeout / 1000
+
+    def remaining():
+        # every query waits at most until the deadline, pyusb waits forever on a timeout of 0
+        left = int((deadline - time.monotonic()) * 1000)
+        if left <= 0:
+            raise defs.CommandException(f"Probe did not finish in {timeout}ms")
+        return min(left, defs.DEFAULT_TIMEOUT)
+
+    record = {"path": pathname(dev), "serial": serial(dev), "idVendor": dev.idVendor, "idProduct": dev.idProduct,
+              "speed": getattr(dev, "speed", None)}
+    cached = (cache or {}).get(cachekey(record["path"], record["serial"]))
+    try:
+        session = device.Device(dev=dev, timeout=min(defs.DEFAULT_TIMEOUT, timeout))
+
+        def ask(request_ob, response_ob):
+            return session.usb.response(request_ob, response_ob, timeout=remaining())
+
+        chip = chipinfo(ask(request.read_chip_info, response.ChipInfo))
+        if cached and cached.get("chip") == chip and all(cached.get(k) == v for k, v in record.items()):
+            return dict(cached, cached=True)
+        record["chip"] = chip
+        queries = (("flashid", lambda: getattr(ask(request.read_flash_id, response.FlashId), "id", None)),
+                   ("flash", lambda: flashinfo(ask(request.read_flash_info, response.FlashInfo))),
+                   ("capability", lambda: capability(ask(request.read_capability, response.Capability))),
+                   ("idb", lambda: idbinfo(session, remaining())))
+        for name, query in queries:
+            record[name] = query()
+    except (defs.MaskromException, IOError) as e:
+        # pyusb errors are IOErrors
+        record["error"] = str(e)
+    record["cached"] = False
+    return record
+
+
+def run(finder=usb.iterdevices, workers=MAX_WORKERS, timeout=PROBE_TIMEOUT, cache=None):
+    # probes all devices with bounded concurrency, returns the records sorted by bus path
+    records = []
+    with concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="inventory") as pool:
+        futures = [pool.submit(probe, dev, timeout, cache) for dev in finder()]
+        for future in concurrent.futures.as_completed(futures):
+            records.append(future.result())
+    return sorted(records, key=lambda record: (record["path"], record["serial"] or ""))
+
+
+def loadcache(path=CACHE_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def savecache(records, path=CACHE_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cache = {cachekey(record["path"], record["serial"]): {k: v for k, v in record.items() if k != "cached"}
+             for record in records if not record.get("error")}
+    with open(path, "w") as f:
+        json.dump(cache, f, indent=1)
+
+
+def flatten(record):
+    row = {}
+    for column in COLUMNS:
+        value = record
+        for part in column.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        row[column] = " ".join(str(v) for v in value) if isinstance(value, list) else value
+    return row
+
+
+def write(records, f, fmt="json"):
+    if fmt == "csv":
+        writer = csv.DictWriter(f, COLUMNS)
+        writer.writeheader()
+        for record in records:
+            writer.writerow(flatten(record))
+    else:
+        json.dump({cachekey(record["path"], record["serial"]): record for record in records}, f, indent=1)
+        f.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="maskrom.inventory", description="Probes all attached maskrom devices")
+    parser.add_argument("-f", "--format", choices=("json", "csv"), default="json")
+    parser.add_argument("-o", "--output", help="write the table to this file instead of stdout")
+    parser.add_argument("-j", "--jobs", type=int, default=MAX_WORKERS, help="devices probed at the same time")
+    parser.add_argument("-t", "--timeout", type=int, default=PROBE_TIMEOUT, help="per device timeout in ms")
+    parser.add_argument("-c", "--cache", default=CACHE_PATH)
+    parser.add_argument("-r", "--refresh", action="store_true", help="probe every device fully")
+    args = parser.parse_args(argv)
+
+    records = run(workers=args.jobs, timeout=args.timeout, cache=None if args.refresh else loadcache(args.cache))
+    savecache(records, args.cache)
+    if args.output:
+        with open(args.output, "w", newline="") as f:
+            write(records, f, args.format)
+    else:
+        write(records, sys.stdout, args.format)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,429 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import collections
+import concurrent.futures
+import ctypes
+import errno
+import os
+import socket
+import sys
+import threading
+import traceback
+
+from maskrom import defs
+from maskrom import device
+from maskrom import response
+from maskrom import scheduler
+
+NBD_PORT = 10809
+NBDMAGIC = 0x4e42444d41474943
+IHAVEOPT = 0x49484156454f5054
+OPTION_REPLY_MAGIC = 0x3e889045565a9
+REQUEST_MAGIC = 0x25609513
+SIMPLE_REPLY_MAGIC = 0x67446698
+
+FLAG_FIXED_NEWSTYLE = 1 << 0
+FLAG_NO_ZEROES = 1 << 1
+
+FLAG_HAS_FLAGS = 1 << 0
+FLAG_READ_ONLY = 1 << 1
+FLAG_SEND_FLUSH = 1 << 2
+FLAG_SEND_FUA = 1 << 3
+FLAG_CAN_MULTI_CONN = 1 << 8
+
+CMD_FLAG_FUA = 1 << 0
+
+OPT_EXPORT_NAME = 1
+OPT_ABORT = 2
+OPT_LIST = 3
+OPT_INFO = 6
+OPT_GO = 7
+
+REP_ACK = 1
+REP_SERVER = 2
+REP_INFO = 3
+REP_ERR_UNSUP = (1 << 31) + 1
+
+INFO_EXPORT = 0
+INFO_BLOCK_SIZE = 3
+
+CMD_READ = 0
+CMD_WRITE = 1
+CMD_DISC = 2
+CMD_FLUSH = 3
+
+MAX_PAYLOAD = 32 * 1024 * 1024
+CACHE_LINES = 512
+READAHEAD_LINES = 8
+DIRTY_LIMIT = 8 * 1024 * 1024
+WORKERS = 8
+
+
+class c_nbdoption(ctypes.BigEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("magic", ctypes.c_uint64),
+        ("option", ctypes.c_uint32),
+        ("length", ctypes.c_uint32),
+        ]
+
+
+class c_nbdoptionreply(ctypes.BigEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("magic", ctypes.c_uint64),
+        ("option", ctypes.c_uint32),
+        ("type", ctypes.c_uint32),
+        ("length", ctypes.c_uint32),
+        ]
+
+
+class c_nbdrequest(ctypes.BigEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("magic", ctypes.c_uint32),
+        ("flags", ctypes.c_uint16),
+        ("type", ctypes.c_uint16),
+        ("handle", ctypes.c_uint64),
+        ("offset", ctypes.c_uint64),
+        ("length", ctypes.c_uint32),
+        ]
+
+
+class c_nbdreply(ctypes.BigEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("magic", ctypes.c_uint32),
+        ("error", ctypes.c_uint32),
+        ("handle", ctypes.c_uint64),
+        ]
+
+
+class BlockCache:
+    # lru cache of device lines, a line is one lba transfer of the link. writes are kept as dirty
+    # blocks overlaid on reads and are coalesced into contiguous write_lba runs when flushed
+    def __init__(self, sched, length, lines=CACHE_LINES, readahead=READAHEAD_LINES, dirtylimit=DIRTY_LIMIT):
+        self.scheduler = sched
+        self.length = length
+        self.lineblocks = sched.device.maxblocks
+        self.linesize = self.lineblocks * defs.BLOCK_SIZE
+        self.numlines = -(-length // self.lineblocks)
+        self.maxlines = lines
+        self.readahead = readahead
+        self.dirtylimit = dirtylimit
+        self._lines = collections.OrderedDict()
+        self._inflight = {}
+        self._versions = collections.Counter()
+        self._dirty = {}
+        self._flushing = {}
+        self._last = None
+        self._lock = threading.RLock()
+        self._writelock = threading.Lock()
+        self._flushlock = threading.Lock()
+
+    def _readline(self, line):
+        offset = line * self.lineblocks
+        count = min(self.lineblocks, self.length - offset)
+        return b"".join(bytes(response.checkbuffer(resp)) for resp in self.scheduler.device.iter_lba(offset, count))
+
+    def _request(self, line, priority):
+        # called with the lock held, concurrent misses of a line share a single device read
+        future = self._inflight.get(line)
+        if future is None:
+            version = self._versions[line]
+            future = self.scheduler.submit(self._readline, line, priority=priority)
+            self._inflight[line] = future
+            future.add_done_callback(lambda f: self._done(line, version, f))
+        return future
+
+    def _done(self, line, version, future):
+        with self._lock:
+            if self._inflight.get(line) is future:
+                del self._inflight[line]
+            if future.exception() is None and self._versions[line] == version:
+                self._lines[line] = future.result()
+                self._lines.move_to_end(line)
+                while len(self._lines) > self.maxlines:
+                    self._lines.popitem(last=False)
+
+    def _getline(self, line):
+        while True:
+            with self._lock:
+                version = self._versions[line]
+                data = self._lines.get(line)
+                if data is not None:
+                    self._lines.move_to_end(line)
+                    return data
+                future = self._request(line, scheduler.PRIORITY_NORMAL)
+            data = future.result()
+            with self._lock:
+                # a flush has written the line while it was read
+                if self._versions[line] == version:
+                    return data
+
+    def _prefetch(self, first, last):
+        with self._lock:
+            sequential = self._last is not None and self._last <= first <= self._last + 1
+            self._last = last
+            if not sequential:
+                return
+            for line in range(last + 1, min(last + 1 + self.readahead, self.numlines)):
+                if line not in self._lines:
+                    self._request(line, scheduler.PRIORITY_BULK)
+
+    def _overlay(self, buffer, offset):
+        with self._lock:
+            if not self._dirty and not self._flushing:
+                return
+            for lba in range(offset // defs.BLOCK_SIZE, defs.blockcount(offset + len(buffer))):
+                block = self._dirty.get(lba) or self._flushing.get(lba)
+                if block is None:
+                    continue
+                start = lba * defs.BLOCK_SIZE
+                lo = max(start, offset)
+                hi = min(start + defs.BLOCK_SIZE, offset + len(buffer))
+                buffer[lo - offset:hi - offset] = block[lo - start:hi - start]
+
+    def read(self, offset, size):
+        # byte offset and size
+        first = offset // self.linesize
+        last = (offset + size - 1) // self.linesize
+        self._prefetch(first, last)
+        lines = range(first, last + 1)
+        while True:
+            with self._lock:
+                versions = [self._versions[line] for line in lines]
+            buffer = bytearray()
+            for line in lines:
+                buffer += self._getline(line)
+            start = offset - first * self.linesize
+            buffer = buffer[start:start + size]
+            with self._lock:
+                self._overlay(buffer, offset)
+                # a flush that finished after the lines were taken has dropped its blocks from the
+                # overlay, so the lines may predate the write and are read again
+                if [self._versions[line] for line in lines] == versions:
+                    return buffer
+
+    def write(self, offset, data):
+        head = offset % defs.BLOCK_SIZE
+        tail = -(offset + len(data)) % defs.BLOCK_SIZE
+        # writes are serialized from the read of the partial blocks to their dirty insert, otherwise
+        # two writes into the same block both merge with the old content and one of them is lost
+        with self._writelock:
+            if head or tail:
+                # partial blocks are merged with their current content
+                buffer = self.read(offset - head, head + len(data) + tail)
+                buffer[head:head + len(data)] = data
+                offset, data = offset - head, buffer
+            data = memoryview(data)
+            with self._lock:
+                for index in range(0, len(data), defs.BLOCK_SIZE):
+                    self._dirty[(offset + index) // defs.BLOCK_SIZE] = bytes(data[index:index + defs.BLOCK_SIZE])
+                full = len(self._dirty) * defs.BLOCK_SIZE >= self.dirtylimit
+        if full:
+            self.flush()
+
+    def flush(self):
+        with self._flushlock:
+            with self._lock:
+                self._flushing, self._dirty = self._dirty, {}
+            for lba, count in defs.itercoalesce((lba, 1) for lba in sorted(self._flushing)):
+                data = b"".join(self._flushing[block] for block in range(lba, lba + count))
+                self.scheduler.write_lba(lba, data, priority=scheduler.PRIORITY_NORMAL)
+            with self._lock:
+                for line in {lba // self.lineblocks for lba in self._flushing}:
+                    self._versions[line] += 1
+                    self._lines.pop(line, None)
+                self._flushing = {}
+
+
+def recvall(conn, size):
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    while view:
+        received = conn.recv_into(view)
+        if not received:
+            raise ConnectionError("Nbd client disconnected")
+        view = view[received:]
+    return buffer
+
+
+class Server:
+    # serves the lba space of a device to nbd clients, requests of a connection are handled by a pool
+    # so that several outstanding requests queue up in the scheduler and replies may be out of order
+    def __init__(self, dev, length=None, readonly=False, name="", workers=WORKERS):
+        if length is None:
+            flashinfo = dev.read_flash_info()
+            if isinstance(flashinfo, response.Unsupported):
+                raise defs.CommandException(flashinfo.msg)
+            length = int(flashinfo.flashsize / defs.BLOCK_SIZE)
+        self.scheduler = scheduler.Scheduler(dev)
+        self.cache = BlockCache(self.scheduler, length)
+        self.size = length * defs.BLOCK_SIZE
+        self.readonly = readonly
+        self.name = name
+        self.workers = workers
+
+    @property
+    def flags(self):
+        flags = FLAG_HAS_FLAGS | FLAG_SEND_FLUSH | FLAG_SEND_FUA | FLAG_CAN_MULTI_CONN
+        if self.readonly:
+            flags |= FLAG_READ_ONLY
+        return flags
+
+    def _optreply(self, conn, option, reptype, data=b""):
+        conn.sendall(bytes(c_nbdoptionreply(magic=OPTION_REPLY_MAGIC, option=option, type=reptype,
+                                            length=len(data))) + data)
+
+    def handshake(self, conn):
+        # fixed newstyle negotiation, returns False when the client aborts
+        conn.sendall(NBDMAGIC.to_bytes(8, "big") + IHAVEOPT.to_bytes(8, "big") +
+                     (FLAG_FIXED_NEWSTYLE | FLAG_NO_ZEROES).to_bytes(2, "big"))
+        clientflags = int.from_bytes(recvall(conn, 4), "big")
+        while True:
+            option = c_nbdoption.from_buffer(recvall(conn, ctypes.sizeof(c_nbdoption)))
+            data = recvall(conn, option.length)
+            if option.option == OPT_EXPORT_NAME:
+                reply = self.size.to_bytes(8, "big") + self.flags.to_bytes(2, "big")
+                if not clientflags & FLAG_NO_ZEROES:
+                    reply += bytes(124)
+                conn.sendall(reply)
+                return True
+            elif option.option in (OPT_INFO, OPT_GO):
+                self._optreply(conn, option.option, REP_INFO, INFO_EXPORT.to_bytes(2, "big") +
+                               self.size.to_bytes(8, "big") + self.flags.to_bytes(2, "big"))
+                self._optreply(conn, option.option, REP_INFO, INFO_BLOCK_SIZE.to_bytes(2, "big") +
+                               defs.BLOCK_SIZE.to_bytes(4, "big") + self.cache.linesize.to_bytes(4, "big") +
+                               MAX_PAYLOAD.to_bytes(4, "big"))
+                self._optreply(conn, option.option, REP_ACK)
+                if option.option == OPT_GO:
+                    return True
+            elif option.option == OPT_LIST:
+                name = self.name.encode()
+                self._optreply(conn, option.option, REP_SERVER, len(name).to_bytes(4, "big") + name)
+                self._optreply(conn, option.option, REP_ACK)
+            elif option.option == OPT_ABORT:
+                self._optreply(conn, option.option, REP_ACK)
+                return False
+            else:
+                self._optreply(conn, option.option, REP_ERR_UNSUP)
+
+    def _reply(self, conn, sendlock, handle, error=0, data=b""):
+        with sendlock:
+            conn.sendall(bytes(c_nbdreply(magic=SIMPLE_REPLY_MAGIC, error=error, handle=handle)))
+            if data:
+                conn.sendall(data)
+
+    def _command(self, conn, sendlock, req, data):
+        try:
+            if req.type == CMD_READ:
+                self._reply(conn, sendlock, req.handle, data=self.cache.read(req.offset, req.length))
+                return
+            if req.type == CMD_WRITE:
+                self.cache.write(req.offset, data)
+                if req.flags & CMD_FLAG_FUA:
+                    self.cache.flush()
+            elif req.type == CMD_FLUSH:
+                self.cache.flush()
+            else:
+                self._reply(conn, sendlock, req.handle, errno.EINVAL)
+                return
+            self._reply(conn, sendlock, req.handle)
+        except Exception:
+            # any failure of a request is an io error to the client, the connection stays up
+            traceback.print_exc(file=sys.stderr)
+            self._reply(conn, sendlock, req.handle, errno.EIO)
+
+    def handle(self, conn):
+        try:
+            if not self.handshake(conn):
+                return
+            sendlock = threading.Lock()
+            with concurrent.futures.ThreadPoolExecutor(self.workers) as pool:
+                while True:
+                    req = c_nbdrequest.from_buffer(recvall(conn, ctypes.sizeof(c_nbdrequest)))
+                    if req.magic != REQUEST_MAGIC:
+                        break
+                    if req.type == CMD_DISC:
+                        break
+                    # the payload has to be taken off the socket before the next request
+                    data = recvall(conn, req.length) if req.type == CMD_WRITE else None
+                    error = 0
+                    if req.length > MAX_PAYLOAD:
+                        error = errno.EINVAL
+                    elif req.offset + req.length > self.size:
+                        error = errno.ENOSPC if req.type == CMD_WRITE else errno.EINVAL
+                    elif req.type == CMD_WRITE and self.readonly:
+                        error = errno.EPERM
+                    if error:
+                        self._reply(conn, sendlock, req.handle, error)
+                        continue
+                    pool.submit(self._command, conn, sendlock, req, data)
+            self.cache.flush()
+        except ConnectionError:
+            self.cache.flush()
+        finally:
+            conn.close()
+
+    def serve_forever(self, sock):
+        while True:
+            conn, _addr = sock.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def close(self):
+        self.cache.flush()
+        self.scheduler.close()
+
+
+def listen(path=None, host="127.0.0.1", port=NBD_PORT):
+    if path:
+        if os.path.exists(path):
+            os.unlink(path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+    else:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((host, port))
+    sock.listen()
+    return sock
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="maskrom.nbd", description="Serves the storage of a device over nbd")
+    parser.add_argument("-d", "--device", type=int, default=0, help="index of the maskrom device")
+    parser.add_argument("-s", "--socket", help="unix socket to listen on instead of tcp")
+    parser.add_argument("-b", "--bind", default="127.0.0.1")
+    parser.add_argument("-p", "--port", type=int, default=NBD_PORT)
+    parser.add_argument("-r", "--readonly", action="store_true")
+    args = parser.parse_args(argv)
+    server = Server(device.Device(args.device), readonly=args.readonly)
+    sock = listen(args.socket, args.bind, args.port)
+    try:
+        server.serve_forever(sock)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sock.close()
+        server.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,171 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import ctypes
+import hashlib
+import operator
+import os
+import re
+
+from maskrom import defs
+from maskrom import response
+
+GPT_SIGNATURE = b"EFI PART"
+GPT_HEADER_LBA = 1
+PARAMETER_MAGIC = b"PARM"
+PARAMETER_LBAS = (0, 0x2000)
+MTDPART = re.compile(r"(-|0x[0-9a-fA-F]+)@(0x[0-9a-fA-F]+)\(([^):]+)(:[^)]*)?\)")
+
+
+class c_gptheader(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("signature", ctypes.c_char * 8),
+        ("revision", ctypes.c_uint32),
+        ("headersize", ctypes.c_uint32),
+        ("headercrc", ctypes.c_uint32),
+        ("reserved0", ctypes.c_uint32),
+        ("currentlba", ctypes.c_uint64),
+        ("backuplba", ctypes.c_uint64),
+        ("firstlba", ctypes.c_uint64),
+        ("lastlba", ctypes.c_uint64),
+        ("guid", ctypes.c_uint8 * 16),
+        ("entrieslba", ctypes.c_uint64),
+        ("numentries", ctypes.c_uint32),
+        ("entrysize", ctypes.c_uint32),
+        ("entriescrc", ctypes.c_uint32),
+        ]
+
+
+class c_gptentry(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("typeguid", ctypes.c_uint8 * 16),
+        ("guid", ctypes.c_uint8 * 16),
+        ("firstlba", ctypes.c_uint64),
+        ("lastlba", ctypes.c_uint64),
+        ("attributes", ctypes.c_uint64),
+        ("name", ctypes.c_uint8 * 72),
+        ]
+
+
+class Partition(defs.Printable):
+    def __init__(self, name, offset, length):
+        self.name = name
+        self.offset = offset
+        self.length = length
+
+    @property
+    def size(self):
+        return defs.PrettyInt(self.length * defs.BLOCK_SIZE)
+
+
+def readlba(device, offset, length):
+    return b"".join(bytes(response.checkbuffer(resp)) for resp in device.iter_lba(offset, length))
+
+
+def parsegpt(header, entries):
+    partitions = {}
+    for index in range(header.numentries):
+        start = index * header.entrysize
+        entry = c_gptentry.from_buffer_copy(entries[start:start + ctypes.sizeof(c_gptentry)])
+        if not any(entry.typeguid):
+            continue
+        name = bytes(entry.name).decode("utf-16-le").rstrip("\0") or f"part{index}"
+        partitions[name] = Partition(name, entry.firstlba, entry.lastlba - entry.firstlba + 1)
+    return partitions
+
+
+def parseparameter(text, totallba=None):
+    partitions = {}
+    for line in text.splitlines():
+        if not line.startswith("CMDLINE:"):
+            continue
+        for size, offset, name, _flags in MTDPART.findall(line):
+            offset = int(offset, 16)
+            if size == "-":
+                if totallba is None:
+                    raise defs.LimitsException(f"Size of growing partition {name} is unknown")
+                length = totallba - offset
+            else:
+                length = int(size, 16)
+            partitions[name] = Partition(name, offset, length)
+    return partitions
+
+
+def read(device, parameterlbas=PARAMETER_LBAS):
+    # returns {name: Partition} from the gpt, or the rockchip parameter when there is no gpt
+    head = readlba(device, 0, GPT_HEADER_LBA + 1)
+    header = c_gptheader.from_buffer_copy(head[GPT_HEADER_LBA * defs.BLOCK_SIZE:][:ctypes.sizeof(c_gptheader)])
+    if header.signature == GPT_SIGNATURE:
+        entries = readlba(device, header.entrieslba, defs.blockcount(header.numentries * header.entrysize))
+        return parsegpt(header, entries)
+
+    for lba in parameterlbas:
+        data = head[:defs.BLOCK_SIZE] if lba == 0 else readlba(device, lba, 1)
+        if data[:4] != PARAMETER_MAGIC:
+            continue
+        size = int.from_bytes(data[4:8], "little")
+        if size + 8 > len(data):
+            data += readlba(device, lba + 1, defs.blockcount(size + 8) - 1)
+        text = data[8:8 + size].decode(errors="replace")
+        totallba = None
+        if "-@" in text:
+            flashinfo = device.read_flash_info()
+            if isinstance(flashinfo, response.Unsupported):
+                raise defs.CommandException(flashinfo.msg)
+            totallba = int(flashinfo.flashsize / defs.BLOCK_SIZE)
+        return parseparameter(text, totallba)
+    raise defs.MaskromException("No gpt or rockchip parameter found on the device")
+
+
+class HashSink:
+    def __init__(self, hashfunc=hashlib.sha256):
+        self.hash = hashfunc()
+
+    def write(self, buffer):
+        self.hash.update(buffer)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def dump(device, partitions, sinkfactory, badblocks=None, remap=False):
+    # partitions are read in the order of their offsets, sinkfactory(partition) returns the sinks
+    # of a partition which are fed in parallel, returns {name: sinks}
+    results = {}
+    for partition in sorted(partitions, key=operator.attrgetter("offset")):
+        sinks = sinkfactory(partition)
+        with defs.Fanout(sinks) as fanout:
+            for resp in defs.Prefetch(device.iter_lba(partition.offset, partition.length, badblocks, remap),
+                                      device.queuedepth):
+                fanout.write(response.checkbuffer(resp))
+        results[partition.name] = sinks
+    return results
+
+
+def dumpfiles(device, names, directory, hashfunc=hashlib.sha256):
+    # dumps the named partitions to <directory>/<name>.img, returns {name: hexdigest}
+    table = read(device)
+    missing = set(names) - set(table)
+    if missing:
+        raise defs.MaskromException(f"Unknown partitions {', '.join(sorted(missing))}")
+
+    def sinkfactory(partition):
+        return [open(os.path.join(directory, partition.name + ".img"), "wb"), HashSink(hashfunc)]
+
+    results = dump(device, [table[name] for name in names], sinkfactory)
+    return {name: sinks[1].hexdigest() for name, sinks in results.items()}
@@ -0,0 +1,331 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+from maskrom import defs
+from maskrom import device
+from maskrom import inventory
+from maskrom import request
+from maskrom import response
+
+OPS = ("read_lba", "write_lba", "read_sdram", "write_sdram")
+# write_lba overwrites the profiled regions of the storage, so it only runs when asked for
+DEFAULT_OPS = ("read_lba", "read_sdram", "write_sdram")
+CHUNK_SIZES = (16 * 1024, 60 * 1024, 256 * 1024, 1024 * 1024)
+# a chunk is a single request, the lengths of the ops are 16 bit blocks and bytes
+MAX_CHUNK = {"read_lba": 0xffff * defs.BLOCK_SIZE, "write_lba": 0xffff * defs.BLOCK_SIZE,
+             "read_sdram": defs.USB_MAX_SDRAM_SIZE, "write_sdram": defs.USB_MAX_SDRAM_SIZE}
+# the read ops also run as streams of the Device iterators behind a Prefetch of each depth,
+# depth 1 is the stream without a Prefetch
+STREAM_OPS = ("read_lba", "read_sdram")
+QUEUE_DEPTHS = (1, 4, 8)
+PATTERNS = ("seq", "rand")
+# start of the region as a fraction of the storage
+REGIONS = {"start": 0.0, "middle": 0.5, "end": 1.0}
+PERCENTILES = (50, 90, 99)
+CASE_SIZE = 4 * 1024 * 1024
+REGION_SPAN = 16 * 1024 * 1024
+RAM_ADDRESS = 0x08000000
+RAM_SPAN = 8 * 1024 * 1024
+DEFAULT_THRESHOLD = 0.3
+RESULTS_PATH = os.path.join(os.path.dirname(inventory.CACHE_PATH), "profile.json")
+
+
+def fingerprint(dev):
+    # what the throughput of a board depends on, the serial tells boards of the same model apart
+    chip = dev.read_chip_info()
+    flashid = getattr(dev.read_flash_id(), "id", None)
+    flash = dev.read_flash_info()
+    return {"chip": getattr(chip, "tag", None), "pid": dev.usb.dev.idProduct,
+            "flashid": flashid.hex() if isinstance(flashid, bytes) else flashid,
+            "flashsize": int(flash.flashsize) if isinstance(flash, response.FlashInfo) else None,
+            "speed": dev.speed, "serial": inventory.serial(dev.usb.dev)}
+
+
+def modelkey(fp):
+    # boards of a model share the soc, the loader and the link speed
+    return f"{fp['chip']}/{fp['pid']:04x}/{fp['speed']}"
+
+
+def boardkey(fp):
+    return f"{modelkey(fp)}/{(fp['flashid'] or '').strip()}/{fp['flashsize']}/{fp['serial'] or ''}"
+
+
+def casename(op, chunk, pattern, region):
+    return f"{op}/{chunk // 1024}k/{pattern}/{region}"
+
+
+def streamname(op, depth, region):
+    return f"{op}/stream/qd{depth}/{region}"
+
+
+def percentile(values, p):
+    # nearest rank
+    ordered = sorted(values)
+    return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)]
+
+
+def iteroffsets(pattern, start, span, chunk, count, rng):
+    slots = max(span // chunk, 1)
+    for index in range(count):
+        slot = rng.randrange(slots) if pattern == "rand" else index % slots
+        yield start + slot * chunk
+
+
+def transfer(dev, op, offset, chunk, payload):
+    # one request of exactly chunk bytes, the iter_ and write_ helpers of Device would split it
+    if op == "read_lba":
+        response.checkbuffer(dev.usb.response(request.read_lba, response.Buffer, offset // defs.BLOCK_SIZE,
+                                              chunk // defs.BLOCK_SIZE))
+    elif op == "write_lba":
+        response.checkstatus(dev.usb.response(request.write_lba, response.Status, offset // defs.BLOCK_SIZE,
+                                              chunk // defs.BLOCK_SIZE, buffer=payload))
+    elif op == "read_sdram":
+        response.checkbuffer(dev.usb.response(request.read_sdram, response.Buffer, offset, chunk))
+    elif op == "write_sdram":
+        response.checkstatus(dev.usb.response(request.write_sdram, response.Status, offset, chunk, buffer=payload))
+    else:
+        raise defs.CommandException(f"Unknown operation {op}")
+
+
+def runcase(dev, op, chunk, offsets, payload):
+    # rockusb is a bulk only transport with a single command in flight, so requests are issued
+    # back to back and there is no queue depth to sweep
+    latencies = []
+    start = time.perf_counter()
+    for offset in offsets:
+        issued = time.perf_counter()
+        transfer(dev, op, offset, chunk, payload)
+        latencies.append(time.perf_counter() - issued)
+    elapsed = time.perf_counter() - start
+    result = {"mbps": len(latencies) * chunk / elapsed / 1024 / 1024, "bytes": len(latencies) * chunk,
+              "seconds": elapsed}
+    result.update({f"p{p}_ms": percentile(latencies, p) * 1000 for p in PERCENTILES})
+    result["max_ms"] = max(latencies) * 1000
+    return result
+
+
+def runstream(dev, op, start, size, depth):
+    # rockusb runs one command at a time, the depth is how far the transfers of the iterator run
+    # ahead of the consumer, which hashes the data like dump and verify do. the latencies are the
+    # waits of the consumer for each chunk
+    if op == "read_lba":
+        chunks = dev.iter_lba(start // defs.BLOCK_SIZE, size // defs.BLOCK_SIZE)
+    else:
+        chunks = dev.iter_ram(start, size)
+    if depth > 1:
+        chunks = defs.Prefetch(chunks, depth)
+    digest = hashlib.sha256()
+    latencies = []
+    received = 0
+    start = time.perf_counter()
+    try:
+        waited = time.perf_counter()
+        for resp in chunks:
+            latencies.append(time.perf_counter() - waited)
+            data = response.checkbuffer(resp)
+            digest.update(data)
+            received += len(data)
+            waited = time.perf_counter()
+    finally:
+        if depth > 1:
+            chunks.close()
+    elapsed = time.perf_counter() - start
+    result = {"mbps": received / elapsed / 1024 / 1024, "bytes": received, "seconds": elapsed}
+    result.update({f"p{p}_ms": percentile(latencies, p) * 1000 for p in PERCENTILES})
+    result["max_ms"] = max(latencies) * 1000
+    return result
+
+
+def regions(dev, op, names, span, ramaddress, ramspan):
+    # (name, start, span) of the profiled windows, sdram has the single window at ramaddress
+    if op.endswith("sdram"):
+        return [("ram", ramaddress, ramspan)]
+    flash = dev.read_flash_info()
+    if not isinstance(flash, response.FlashInfo):
+        raise defs.CommandException(f"Can not size the storage: {flash}")
+    capacity = int(flash.flashsize)
+    span = min(span, capacity)
+    return [(name, min(int(REGIONS[name] * capacity), capacity - span) // defs.BLOCK_SIZE * defs.BLOCK_SIZE, span)
+            for name in names]
+
+
+def sweep(dev, ops=DEFAULT_OPS, chunks=CHUNK_SIZES, depths=QUEUE_DEPTHS, patterns=PATTERNS, names=tuple(REGIONS),
+          size=CASE_SIZE, span=REGION_SPAN, ramaddress=RAM_ADDRESS, ramspan=RAM_SPAN, seed=0, progress=None):
+    # returns {casename: result} of every combination, chunks the op can not take in one request
+    # are skipped, a case the device fails has an error instead of the measurements
+    results = {}
+    for op in ops:
+        for region, start, regionspan in regions(dev, op, names, span, ramaddress, ramspan):
+            for chunk in chunks:
+                if chunk % defs.BLOCK_SIZE:
+                    raise defs.LimitsException(f"Chunk size {chunk} is not a multiple of {defs.BLOCK_SIZE}")
+                if chunk > MAX_CHUNK[op] or chunk > regionspan:
+                    continue
+                payload = random.Random(seed).randbytes(chunk) if op.startswith("write") else None
+                for pattern in patterns:
+                    offsets = iteroffsets(pattern, start, regionspan, chunk, max(size // chunk, 1),
+                                          random.Random(seed))
+                    name = casename(op, chunk, pattern, region)
+                    try:
+                        results[name] = runcase(dev, op, chunk, offsets, payload)
+                    except defs.CommandException as e:
+                        results[name] = {"error": str(e)}
+                    if progress:
+                        progress(name, results[name])
+            if op not in STREAM_OPS:
+                continue
+            for depth in depths:
+                name = streamname(op, depth, region)
+                try:
+                    results[name] = runstream(dev, op, start, min(size, regionspan), depth)
+                except defs.CommandException as e:
+                    results[name] = {"error": str(e)}
+                if progress:
+                    progress(name, results[name])
+    return results
+
+
+def load(path=RESULTS_PATH):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save(store, path=RESULTS_PATH):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(store, f, indent=1)
+
+
+def record(store, fp, results):
+    # merges the results into the board entry of the store, returns the store
+    board = store.setdefault(boardkey(fp), {"fingerprint": fp, "model": modelkey(fp), "results": {}})
+    board["fingerprint"] = fp
+    board["updated"] = time.time()
+    board["results"].update(results)
+    return store
+
+
+def baseline(store, fp):
+    # {casename: median mbps} over the other boards of the same model
+    samples = {}
+    for key, board in store.items():
+        if key == boardkey(fp) or board.get("model") != modelkey(fp):
+            continue
+        for name, result in board["results"].items():
+            if "error" in result:
+                continue
+            samples.setdefault(name, []).append(result["mbps"])
+    return {name: statistics.median(values) for name, values in samples.items()}
+
+
+def degraded(results, base, threshold=DEFAULT_THRESHOLD):
+    # returns {casename: ratio} of the cases slower than the baseline beyond threshold
+    slow = {}
+    for name, result in results.items():
+        if name in base and "error" not in result and result["mbps"] < base[name] * (1 - threshold):
+            slow[name] = result["mbps"] / base[name]
+    return slow
+
+
+def sizes(text):
+    return [int(size, 0) * 1024 for size in text.split(",")]
+
+
+def numbers(text):
+    return [int(number, 0) for number in text.split(",")]
+
+
+def words(choices):
+    def parse(text):
+        values = text.split(",")
+        for value in values:
+            if value not in choices:
+                raise argparse.ArgumentTypeError(f"{value} is not one of {', '.join(choices)}")
+        return values
+    return parse
+
+
+def printresult(name, result):
+    if "error" in result:
+        print(f"{name:<40}{result['error']}")
+        return
+    print(f"{name:<40}{result['mbps']:>10.2f}MB/s" +
+          "".join(f"{result[f'p{p}_ms']:>10.3f}" for p in PERCENTILES) + f"{result['max_ms']:>10.3f}ms")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="maskrom.profiler", description="Throughput sweeps of a maskrom device")
+    parser.add_argument("-d", "--device", type=int, default=0, help="index of the maskrom device")
+    parser.add_argument("--ops", type=words(OPS), default=list(DEFAULT_OPS),
+                        help=f"comma separated, of {', '.join(OPS)}")
+    parser.add_argument("--chunks", type=sizes, default=list(CHUNK_SIZES), help="comma separated chunk sizes in kB")
+    parser.add_argument("--depths", type=numbers, default=list(QUEUE_DEPTHS),
+                        help="comma separated prefetch depths of the read streams")
+    parser.add_argument("--patterns", type=words(PATTERNS), default=list(PATTERNS))
+    parser.add_argument("--regions", type=words(tuple(REGIONS)), default=list(REGIONS))
+    parser.add_argument("--size", type=int, default=CASE_SIZE // 1024, help="kB transferred per case")
+    parser.add_argument("--span", type=int, default=REGION_SPAN // 1024, help="kB of a storage region")
+    parser.add_argument("--ram-address", type=lambda text: int(text, 0), default=RAM_ADDRESS)
+    parser.add_argument("--ram-span", type=int, default=RAM_SPAN // 1024, help="kB of the sdram window")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--destructive", action="store_true", help="allow write_lba, overwrites the regions")
+    parser.add_argument("--usb3-subcode", type=lambda text: int(text, 0),
+                        help="switch to usb3 first with this unconfirmed device_reset subcode")
+    parser.add_argument("-s", "--store", default=RESULTS_PATH, help="json results per board fingerprint")
+    parser.add_argument("-t", "--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="allowed slow down ratio against the model baseline")
+    parser.add_argument("--sim", action="store_true", help="profile a simulated device with a modelled link")
+    args = parser.parse_args(argv)
+
+    if "write_lba" in args.ops and not args.destructive:
+        parser.error("write_lba overwrites the profiled regions, it needs --destructive")
+    if args.sim:
+        from maskrom import sim
+        host = sim.SimHost()
+        host.plug(timing=True, rambase=args.ram_address, ramsize=args.ram_span * 1024)
+        dev = host.open(args.device)
+    else:
+        dev = device.Device(args.device)
+    if args.usb3_subcode is not None:
+        dev = dev.switch_usb3(subcode=args.usb3_subcode)
+
+    fp = fingerprint(dev)
+    print(f"{boardkey(fp):<40}{'':>14}" + "".join(f"{f'p{p}':>10}" for p in PERCENTILES) + f"{'max':>10}")
+    results = sweep(dev, args.ops, args.chunks, args.depths, args.patterns, args.regions, args.size * 1024,
+                    args.span * 1024, args.ram_address, args.ram_span * 1024, args.seed, printresult)
+    store = load(args.store)
+    slow = degraded(results, baseline(store, fp), args.threshold)
+    save(record(store, fp, results), args.store)
+    for name, ratio in slow.items():
+        print(f"{name} is at {ratio:.2f}x of the {modelkey(fp)} baseline", file=sys.stderr)
+    return 1 if slow else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
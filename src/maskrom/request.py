@@ -107,6 +107,18 @@ def write_lba(pos, count):
                      op=op.write_lba(address=pos, length=count))
 
 
+def read_spi_flash(pos, count):
+    return c_request(sign=SIGNATURE, tag=gettag(),
+                     flag=DIRECTION_IN, cblen=10, length=count * SECTOR_SIZE,
+                     op=op.read_spi_flash(address=pos, length=count))
+
+
+def write_spi_flash(pos, count):
+    return c_request(sign=SIGNATURE, tag=gettag(),
+                     flag=DIRECTION_OUT, cblen=10, length=count * SECTOR_SIZE,
+                     op=op.write_spi_flash(address=pos, length=count))
+
+
 def read_flash_info():
     return c_request(sign=SIGNATURE, tag=gettag(),
                      flag=DIRECTION_IN, cblen=6, length=defs.USB_MAX_TRANSFER_SIZE,
@@ -125,6 +137,15 @@ def erase_lba(pos, count):
                      op=op.erase_lba(address=pos, length=count))
 
 
+def test_bad_block(pos, count, chipselect=0):
+    if count > defs.USB_MAX_TEST_BLOCKS:
+        raise defs.LimitsException(f"Maximum allowed number of blocks to test is {defs.USB_MAX_TEST_BLOCKS} but {count} given")
+
+    return c_request(sign=SIGNATURE, tag=gettag(),
+                     flag=DIRECTION_IN, cblen=10, length=int(defs.USB_MAX_TEST_BLOCKS / 8),
+                     op=op.test_bad_block(subcode=chipselect, address=pos, length=count))
+
+
 def read_capability():
     return c_request(sign=SIGNATURE, tag=gettag(),
                      flag=DIRECTION_IN, cblen=6, length=8,
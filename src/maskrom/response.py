@@ -155,4 +155,24 @@ class Buffer:
         self.buffer = req.buffer
 
     def __repr__(self):
-        return f"Buffer({len(self.buffer)})"
+        return f"Buffer({None if self.buffer is None else len(self.buffer)})"
+
+
+class Blank(Buffer):
+    # stands in for data which is not read from the device, ie: bad blocks
+    def __init__(self, size, fill=0xff):
+        self.buffer = bytes([fill]) * size
+
+
+def checkbuffer(resp):
+    if isinstance(resp, Buffer) and resp.buffer is None:
+        raise defs.CommandException("Request failed: no data was returned")
+    if not isinstance(resp, Buffer):
+        raise defs.CommandException(f"Request failed: {resp}")
+    return resp.buffer
+
+
+def checkstatus(resp):
+    if not isinstance(resp, Status) or not resp.status:
+        raise defs.CommandException(f"Request failed: {resp}")
+    return resp
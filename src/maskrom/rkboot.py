@@ -0,0 +1,126 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import ctypes
+import mmap
+import os
+import time
+
+from maskrom import defs
+
+RKBOOT_TAGS = (b"BOOT", b"LDR ")
+ENTRY_471 = 1
+ENTRY_472 = 2
+ENTRY_LOADER = 4
+
+
+class c_rkboothead(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("tag", ctypes.c_char * 4),
+        ("size", ctypes.c_uint16),
+        ("version", ctypes.c_uint32),
+        ("mergerversion", ctypes.c_uint32),
+        ("year", ctypes.c_uint16),
+        ("month", ctypes.c_uint8),
+        ("day", ctypes.c_uint8),
+        ("hour", ctypes.c_uint8),
+        ("minute", ctypes.c_uint8),
+        ("second", ctypes.c_uint8),
+        ("chip", ctypes.c_uint32),
+        ("code471num", ctypes.c_uint8),
+        ("code471offset", ctypes.c_uint32),
+        ("code471size", ctypes.c_uint8),
+        ("code472num", ctypes.c_uint8),
+        ("code472offset", ctypes.c_uint32),
+        ("code472size", ctypes.c_uint8),
+        ("loadernum", ctypes.c_uint8),
+        ("loaderoffset", ctypes.c_uint32),
+        ("loadersize", ctypes.c_uint8),
+        ("signflag", ctypes.c_uint8),
+        ("rc4flag", ctypes.c_uint8),
+        ("reserved0", ctypes.c_uint8 * 57),
+        ]
+
+
+class c_rkbootentry(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("size", ctypes.c_uint8),
+        ("type", ctypes.c_uint32),
+        ("name", ctypes.c_uint8 * 40),
+        ("offset", ctypes.c_uint32),
+        ("datasize", ctypes.c_uint32),
+        ("delay", ctypes.c_uint32),
+        ]
+
+
+class Entry(defs.Printable):
+    def __init__(self, entry, data):
+        self.type = entry.type
+        self.name = bytes(entry.name).decode("utf-16-le", errors="replace").rstrip("\0")
+        self.size = defs.PrettyInt(entry.datasize)
+        self.delay = entry.delay
+        self._data = data
+
+    @property
+    def data(self):
+        return self._data
+
+
+class Loader(defs.Printable):
+    def __init__(self, source):
+        # source is a path or a bytes like object, ie: rkfw.Firmware.loader
+        if isinstance(source, (str, os.PathLike)):
+            with open(source, "rb") as f:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(source).cast("B")
+        head = c_rkboothead.from_buffer_copy(self._view[:ctypes.sizeof(c_rkboothead)])
+        if head.tag not in RKBOOT_TAGS:
+            raise defs.MaskromException(f"Unknown rkboot tag {head.tag}")
+        self.chip = head.chip
+        self.version = head.version
+        self.rc4 = not head.rc4flag
+        self.entries471 = self._entries(head.code471num, head.code471offset, head.code471size)
+        self.entries472 = self._entries(head.code472num, head.code472offset, head.code472size)
+        self.loaders = self._entries(head.loadernum, head.loaderoffset, head.loadersize)
+
+    def _entries(self, num, offset, size):
+        entries = []
+        for index in range(num):
+            start = offset + index * size
+            entry = c_rkbootentry.from_buffer_copy(self._view[start:start + ctypes.sizeof(c_rkbootentry)])
+            if entry.offset + entry.datasize > len(self._view):
+                raise defs.LimitsException(f"Rkboot entry {index} is beyond the end of the loader")
+            entries.append(Entry(entry, self._view[entry.offset:entry.offset + entry.datasize]))
+        return entries
+
+
+def boot(dev, loader, encrypt=None, wait=True, timeout=defs.REENUMERATION_TIMEOUT):
+    # uploads 471 entries to sram and 472 entries to dram in order, honoring the delays in ms,
+    # entries are rc4 encrypted as the rc4flag of the header says unless encrypt is given
+    if not isinstance(loader, Loader):
+        loader = Loader(loader)
+    if encrypt is None:
+        encrypt = loader.rc4
+    for entries, load in ((loader.entries471, dev.load_sram), (loader.entries472, dev.load_dram)):
+        for entry in entries:
+            load(entry.data, encrypt)
+            if entry.delay:
+                time.sleep(entry.delay / 1000)
+    if wait:
+        return dev.wait_for_reenumeration(timeout)
+    return dev
@@ -0,0 +1,165 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import ctypes
+import hashlib
+import mmap
+
+from maskrom import defs
+
+RKFW_MAGIC = b"RKFW"
+RKAF_MAGIC = b"RKAF"
+RKAF_MAX_PARTS = 16
+NO_NAND_ADDRESS = 0xffffffff
+
+_cache = {}
+
+
+class c_rkfwheader(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("magic", ctypes.c_char * 4),
+        ("headlen", ctypes.c_uint16),
+        ("version", ctypes.c_uint32),
+        ("code", ctypes.c_uint32),
+        ("year", ctypes.c_uint16),
+        ("month", ctypes.c_uint8),
+        ("day", ctypes.c_uint8),
+        ("hour", ctypes.c_uint8),
+        ("minute", ctypes.c_uint8),
+        ("second", ctypes.c_uint8),
+        ("chip", ctypes.c_uint32),
+        ("loaderoffset", ctypes.c_uint32),
+        ("loaderlength", ctypes.c_uint32),
+        ("imageoffset", ctypes.c_uint32),
+        ("imagelength", ctypes.c_uint32),
+        ]
+
+
+class c_rkafpart(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("name", ctypes.c_char * 32),
+        ("filename", ctypes.c_char * 60),
+        ("nandsize", ctypes.c_uint32),
+        ("pos", ctypes.c_uint32),
+        ("nandaddr", ctypes.c_uint32),
+        ("paddedsize", ctypes.c_uint32),
+        ("size", ctypes.c_uint32),
+        ]
+
+
+class c_rkafheader(ctypes.LittleEndianStructure):
+    _pack_ = 1
+    _fields_ = [
+        ("magic", ctypes.c_char * 4),
+        ("length", ctypes.c_uint32),
+        ("model", ctypes.c_char * 0x22),
+        ("id", ctypes.c_char * 0x1e),
+        ("manufacturer", ctypes.c_char * 0x38),
+        ("unknown0", ctypes.c_uint32),
+        ("version", ctypes.c_uint32),
+        ("numparts", ctypes.c_uint32),
+        ("parts", c_rkafpart * RKAF_MAX_PARTS),
+        ]
+
+
+class Member(defs.Printable):
+    def __init__(self, name, filename, offset, size, nandaddr=NO_NAND_ADDRESS, nandsize=0):
+        self.name = name
+        self.filename = filename
+        self.offset = offset
+        self.size = defs.PrettyInt(size)
+        self.nandaddr = nandaddr
+        self.nandsize = nandsize
+
+    @property
+    def flashable(self):
+        return self.nandaddr != NO_NAND_ADDRESS
+
+
+def parse(buffer):
+    # returns (loader member or None, {name: member}) of an rkfw or bare rkaf image
+    members = {}
+    loader = None
+    base = 0
+    if buffer[:4] == RKFW_MAGIC:
+        header = c_rkfwheader.from_buffer_copy(buffer[:ctypes.sizeof(c_rkfwheader)])
+        loader = Member("loader", "", header.loaderoffset, header.loaderlength)
+        base = header.imageoffset
+    if buffer[base:base + 4] != RKAF_MAGIC:
+        raise defs.MaskromException("Not a rockchip update image")
+    afheader = c_rkafheader.from_buffer_copy(buffer[base:base + ctypes.sizeof(c_rkafheader)])
+    for part in afheader.parts[:min(afheader.numparts, RKAF_MAX_PARTS)]:
+        name = part.name.decode(errors="replace")
+        members[name] = Member(name, part.filename.decode(errors="replace"), base + part.pos, part.size,
+                               part.nandaddr, part.nandsize)
+    return loader, members
+
+
+def indexkey(buffer):
+    # covers all that parse reads: the rkfw header and the rkaf header with its partition table
+    m = hashlib.sha256(buffer[:ctypes.sizeof(c_rkfwheader)])
+    base = 0
+    if buffer[:4] == RKFW_MAGIC:
+        base = c_rkfwheader.from_buffer_copy(buffer[:ctypes.sizeof(c_rkfwheader)]).imageoffset
+    m.update(buffer[base:base + ctypes.sizeof(c_rkafheader)])
+    return m.digest(), len(buffer)
+
+
+class Firmware(defs.Printable):
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        key = indexkey(self._mmap)
+        if key not in _cache:
+            _cache[key] = parse(self._mmap)
+        self._loader, self.members = _cache[key]
+
+    def _view(self, member):
+        if member.offset + member.size > len(self._mmap):
+            raise defs.LimitsException(f"Member {member.name} is beyond the end of {self.path}")
+        return memoryview(self._mmap)[member.offset:member.offset + member.size]
+
+    @property
+    def loader(self):
+        # the rkboot loader blob of an rkfw image, None for bare rkaf images
+        return self._view(self._loader) if self._loader else None
+
+    def view(self, name):
+        return self._view(self.members[name])
+
+    def iterflashable(self):
+        for member in sorted(self.members.values(), key=lambda m: m.nandaddr):
+            if member.flashable:
+                yield member
+
+    def write(self, device, name, badblocks=None, remap=False):
+        member = self.members[name]
+        if not member.flashable:
+            raise defs.MaskromException(f"Member {name} has no flash address")
+        return device.write_lba(member.nandaddr, self.view(name), badblocks=badblocks, remap=remap)
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,129 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import collections
+import concurrent.futures
+import functools
+import itertools
+import queue
+import threading
+
+from maskrom import defs
+
+# lower runs first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_BULK = 20
+
+_end = object()
+_stop = object()
+
+
+class Scheduler:
+    # owns the transport of a device, a single worker runs one unit at a time and every unit is
+    # a whole CBW/data/CSW exchange, so commands of any thread never interleave on the endpoints
+    # and a pending command of higher priority waits for at most one chunk of a bulk job
+    def __init__(self, dev):
+        self.device = dev
+        self._queue = queue.PriorityQueue()
+        self._seq = itertools.count()
+        self._thread = threading.Thread(target=self._run, daemon=True, name="maskrom-scheduler")
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            _priority, _seq, future, func = self._queue.get()
+            if func is _stop:
+                break
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(func())
+            except BaseException as e:
+                future.set_exception(e)
+
+    def submit(self, func, *args, priority=PRIORITY_NORMAL, **kwargs):
+        # units of the same priority run in submission order
+        future = concurrent.futures.Future()
+        self._queue.put((priority, next(self._seq), future, functools.partial(func, *args, **kwargs)))
+        return future
+
+    def call(self, func, *args, priority=PRIORITY_NORMAL, **kwargs):
+        return self.submit(func, *args, priority=priority, **kwargs).result()
+
+    def iterjob(self, iterable, priority=PRIORITY_BULK, depth=None):
+        # each item of a bulk job is scheduled as its own unit, depth units are kept queued so
+        # that the bus stays busy while the consumer works on the previous item
+        iterator = iter(iterable)
+        depth = depth or self.device.queuedepth
+        pending = collections.deque()
+        try:
+            while True:
+                while len(pending) < depth:
+                    pending.append(self.submit(next, iterator, _end, priority=priority))
+                item = pending.popleft().result()
+                if item is _end:
+                    break
+                yield item
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def close(self):
+        # queued units run before the worker stops
+        self._queue.put((float("inf"), next(self._seq), None, _stop))
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def read_flash_id(self, priority=PRIORITY_HIGH):
+        return self.call(self.device.read_flash_id, priority=priority)
+
+    def read_flash_info(self, priority=PRIORITY_HIGH):
+        return self.call(self.device.read_flash_info, priority=priority)
+
+    def read_chip_info(self, priority=PRIORITY_HIGH):
+        return self.call(self.device.read_chip_info, priority=priority)
+
+    def test_unit_ready(self, priority=PRIORITY_HIGH):
+        return self.call(self.device.test_unit_ready, priority=priority)
+
+    def read_capability(self, priority=PRIORITY_HIGH):
+        return self.call(self.device.read_capability, priority=priority)
+
+    def iter_lba(self, offset, length, badblocks=None, remap=False, priority=PRIORITY_BULK):
+        return self.iterjob(self.device.iter_lba(offset, length, badblocks, remap), priority)
+
+    def iter_ram(self, offset, size, priority=PRIORITY_BULK):
+        return self.iterjob(self.device.iter_ram(offset, size), priority)
+
+    def write_lba(self, offset, source, badblocks=None, remap=False, priority=PRIORITY_BULK):
+        written = 0
+        for chunk in defs.Reader(source).iterchunks(self.device.maxblocks * defs.BLOCK_SIZE):
+            written += self.call(self.device.write_lba, offset, chunk, badblocks=badblocks, remap=remap,
+                                 priority=priority)
+            offset += defs.blockcount(len(chunk))
+        return written
+
+    def write_ram(self, offset, source, priority=PRIORITY_NORMAL):
+        written = 0
+        for chunk in defs.Reader(source).iterchunks(defs.USB_MAX_SDRAM_SIZE):
+            written += self.call(self.device.write_ram, offset + written, chunk, priority=priority)
+        return written
@@ -0,0 +1,257 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import array
+import collections
+import copy
+import ctypes
+import itertools
+import time
+
+from maskrom import defs
+from maskrom import device
+from maskrom import request
+from maskrom import response
+
+EP_IN = 0x81
+EP_OUT = 0x01
+USB2_BUS = 1
+USB3_BUS = 2
+# (bytes per second, seconds of overhead per transfer) of the modelled links
+LINK_MODEL = {defs.USB_SPEED_HIGH: (35 * 1024 * 1024, 0.0005),
+              defs.USB_SPEED_SUPER: (300 * 1024 * 1024, 0.0001)}
+FLASH_NUMCHIPS = 2
+# the device_reset subcode the simulated loader switches to usb3 on
+SWITCH_USB3_SUBCODE = 5
+
+
+class Endpoint:
+    def __init__(self, address, transfer):
+        self.bEndpointAddress = address
+        self._transfer = transfer
+
+    def write(self, data, timeout=None):
+        return self._transfer(data)
+
+    def read(self, size, timeout=None):
+        return self._transfer(size)
+
+
+class Storage:
+    # the state of a board which survives re-enumerations
+    def __init__(self, size, spisize, ramsize, rambase, blocksize, badblocks):
+        self.lba = bytearray(size)
+        self.spi = bytearray(b"\xff" * spisize)
+        self.ram = bytearray(ramsize)
+        self.rambase = rambase
+        self.blocksize = blocksize
+        self.badblocks = set(badblocks)
+        self.loads = []
+
+
+class SimDevice:
+    # a pyusb device lookalike speaking the rockusb protocol from memory, ie: Device(dev=SimDevice(...))
+    idVendor = defs.RK_VENDOR_ID
+
+    def __init__(self, host=None, pid=0x350b, size=64 * 1024 * 1024, spisize=16 * 1024 * 1024,
+                 ramsize=16 * 1024 * 1024, rambase=0, blocksize=512 * 1024, badblocks=(),
+                 chiptag="3588", flashid=b"EMMC ", usb3=True, speed=defs.USB_SPEED_HIGH, timing=False):
+        self.host = host
+        self.idProduct = pid
+        self.bus = USB3_BUS if speed >= defs.USB_SPEED_SUPER else USB2_BUS
+        self.address = 0
+        self.port_numbers = (1,)
+        self.speed = speed
+        self.usb3 = usb3
+        self.chiptag = chiptag
+        self.flashid = flashid
+        self.timing = timing
+        self.storage = Storage(size, spisize, ramsize, rambase, blocksize, badblocks)
+        self._connect()
+
+    def _connect(self):
+        # a fresh usb session, nothing in flight
+        self._pending = None
+        self._loading = {}
+        self._in = collections.deque()
+        self._endpoints = [Endpoint(EP_IN, self._bulkin), Endpoint(EP_OUT, self._bulkout)]
+        self._handlers = {0: self._test_unit_ready,
+                          1: self._read_flash_id,
+                          3: self._test_bad_block,
+                          20: self._read_lba,
+                          21: self._write_lba,
+                          23: self._read_sdram,
+                          24: self._write_sdram,
+                          25: self._execute_sdram,
+                          26: self._read_flash_info,
+                          27: self._read_chip_info,
+                          33: self._read_spi_flash,
+                          34: self._write_spi_flash,
+                          37: self._erase_lba,
+                          170: self._read_capability,
+                          255: self._device_reset,
+                          }
+
+    def reenumerate(self, speed=None):
+        # the same board shows up as a new device, on the superspeed bus when switched to usb3
+        dev = copy.copy(self)
+        dev.speed = self.speed if speed is None else speed
+        dev.bus = USB3_BUS if dev.speed >= defs.USB_SPEED_SUPER else USB2_BUS
+        dev._connect()
+        if self.host:
+            self.host.detach(self)
+            self.host.attach(dev)
+        return dev
+
+    def get_active_configuration(self):
+        return {(0, 0): self._endpoints}
+
+    def ctrl_transfer(self, bmRequestType, bRequest, wValue=0, wIndex=0, data_or_wLength=None, timeout=None):
+        data = bytes(data_or_wLength)
+        self._delay(len(data))
+        self._loading[wIndex] = self._loading.get(wIndex, b"") + data
+        # the transfer ends with the first unaligned packet
+        if len(data) % defs.USB_TRANSFER_ALIGN:
+            self.storage.loads.append((wIndex, self._loading.pop(wIndex)))
+            if wIndex == defs.CONTROL_INDEX_DRAM:
+                self.reenumerate()
+        return len(data)
+
+    def _delay(self, size):
+        if self.timing:
+            bandwidth, latency = LINK_MODEL[self.speed]
+            time.sleep(latency + size / bandwidth)
+
+    def _bulkout(self, data):
+        data = bytes(data)
+        self._delay(len(data))
+        if self._pending is not None:
+            req, self._pending = self._pending, None
+            self._respond(req, data)
+            return len(data)
+        req = request.c_request.from_buffer_copy(data[:ctypes.sizeof(request.c_request)])
+        if req.flag == request.DIRECTION_OUT and req.length:
+            self._pending = req
+        else:
+            self._respond(req)
+        return len(data)
+
+    def _bulkin(self, size):
+        if not self._in:
+            raise defs.CommandException("Simulated read timed out", None, 110)
+        data = self._in.popleft()
+        self._delay(len(data))
+        return array.array("B", data[:size])
+
+    def _respond(self, req, data=None):
+        handler = self._handlers.get(req.op.code)
+        try:
+            payload = handler(req.op, data) if handler else None
+            status = response.STATUS_OK if handler else response.STATUS_FAIL
+        except (IndexError, ValueError):
+            payload, status = None, response.STATUS_FAIL
+        if payload is not None:
+            self._in.append(bytes(payload))
+        self._in.append(bytes(response.c_response(sign=response.SIGNATURE, tag=req.tag, status=status)))
+
+    def _range(self, buffer, offset, size):
+        if offset < 0 or offset + size > len(buffer):
+            raise IndexError(f"Access of {size} bytes at {offset} is out of range")
+        return slice(offset, offset + size)
+
+    def _test_unit_ready(self, op, data):
+        return None
+
+    def _read_flash_id(self, op, data):
+        return self.flashid
+
+    def _read_flash_info(self, op, data):
+        return bytes(response.c_flashinfo(flashsize=len(self.storage.lba) * FLASH_NUMCHIPS // 1024,
+                                          blocksize=self.storage.blocksize * FLASH_NUMCHIPS // 1024,
+                                          pagesize=4, ecc=0, accesstime=0, manufacturer=0, chipselect=1))
+
+    def _read_chip_info(self, op, data):
+        return (self.chiptag[::-1] + "2202" + "01" + "01" + "V100"[::-1]).encode()
+
+    def _read_capability(self, op, data):
+        return bytes([0x09, 0x10 if self.usb3 else 0x00]) + bytes(6)
+
+    def _test_bad_block(self, op, data):
+        bitmap = bytearray(int(defs.USB_MAX_TEST_BLOCKS / 8))
+        for index in range(op.length):
+            if op.address + index in self.storage.badblocks:
+                bitmap[index >> 3] |= 1 << (index & 7)
+        return bitmap
+
+    def _read_lba(self, op, data):
+        return self.storage.lba[self._range(self.storage.lba, op.address * defs.BLOCK_SIZE,
+                                            op.length * defs.BLOCK_SIZE)]
+
+    def _write_lba(self, op, data):
+        self.storage.lba[self._range(self.storage.lba, op.address * defs.BLOCK_SIZE, len(data))] = data
+
+    def _erase_lba(self, op, data):
+        span = self._range(self.storage.lba, op.address * defs.BLOCK_SIZE, op.length * defs.BLOCK_SIZE)
+        self.storage.lba[span] = b"\xff" * (span.stop - span.start)
+
+    def _read_spi_flash(self, op, data):
+        return self.storage.spi[self._range(self.storage.spi, op.address * defs.BLOCK_SIZE,
+                                            op.length * defs.BLOCK_SIZE)]
+
+    def _write_spi_flash(self, op, data):
+        self.storage.spi[self._range(self.storage.spi, op.address * defs.BLOCK_SIZE, len(data))] = data
+
+    def _read_sdram(self, op, data):
+        return self.storage.ram[self._range(self.storage.ram, op.address - self.storage.rambase, op.length)]
+
+    def _write_sdram(self, op, data):
+        self.storage.ram[self._range(self.storage.ram, op.address - self.storage.rambase, len(data))] = data
+
+    def _execute_sdram(self, op, data):
+        self._range(self.storage.ram, op.address - self.storage.rambase, 0)
+
+    def _device_reset(self, op, data):
+        if op.subcode == SWITCH_USB3_SUBCODE:
+            if not self.usb3:
+                raise ValueError("Link can not switch to usb3")
+            self.reenumerate(defs.USB_SPEED_SUPER)
+        else:
+            self.reenumerate()
+
+
+class SimHost:
+    # the usb host the simulated devices are plugged in, its iterdevices is the finder of Usb and Device
+    def __init__(self):
+        self.devices = []
+        self._addresses = itertools.count(1)
+
+    def attach(self, dev):
+        dev.host = self
+        dev.address = next(self._addresses)
+        self.devices.append(dev)
+        return dev
+
+    def detach(self, dev):
+        self.devices.remove(dev)
+
+    def plug(self, **kwargs):
+        return self.attach(SimDevice(self, **kwargs))
+
+    def iterdevices(self):
+        return list(self.devices)
+
+    def open(self, offset=0, timeout=defs.DEFAULT_TIMEOUT):
+        return device.Device(offset, timeout, finder=self.iterdevices)
@@ -0,0 +1,160 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+import json
+import mmap
+import re
+
+from maskrom import defs
+from maskrom import response
+
+CHUNK_SIZE = defs.USB_MAX_SDRAM_SIZE
+INDEX_SUFFIX = ".json"
+CHANGED = re.compile(rb"[^\x00]+")
+
+
+def hashchunk(buffer):
+    return hashlib.blake2b(buffer, digest_size=16).hexdigest()
+
+
+class Region(defs.Printable):
+    def __init__(self, name, address, size, offset=0, hashes=None):
+        self.name = name
+        self.address = address
+        self.size = defs.PrettyInt(size)
+        self.offset = offset
+        self.hashes = hashes or []
+
+    def todict(self):
+        return {"name": self.name, "address": self.address, "size": int(self.size),
+                "offset": self.offset, "hashes": self.hashes}
+
+
+class Snapshot(defs.Printable):
+    def __init__(self, path):
+        self.path = path
+        with open(path + INDEX_SUFFIX) as f:
+            index = json.load(f)
+        self.chunksize = index.get("chunksize")
+        self.regions = {r["name"]: Region(**r) for r in index["regions"]}
+        self._file = open(path, "rb")
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+
+    @property
+    def size(self):
+        return sum(r.size for r in self.regions.values())
+
+    def view(self, name):
+        region = self.regions[name]
+        return memoryview(self._mmap)[region.offset:region.offset + region.size]
+
+    def close(self):
+        if self._mmap:
+            self._mmap.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def dump(device, path, regions):
+    # regions: {name: (address, size)}
+    index = []
+    offset = 0
+    for name, (address, size) in regions.items():
+        index.append(Region(name, address, size, offset))
+        offset += size
+
+    with open(path, "w+b") as f:
+        f.truncate(offset)
+        if offset:
+            with mmap.mmap(f.fileno(), offset) as mm:
+                for region in index:
+                    pos = region.offset
+                    for resp in defs.Prefetch(device.iter_ram(region.address, region.size)):
+                        buffer = response.checkbuffer(resp)
+                        mm[pos:pos + len(buffer)] = buffer
+                        region.hashes.append(hashchunk(buffer))
+                        pos += len(buffer)
+
+    with open(path + INDEX_SUFFIX, "w") as f:
+        json.dump({"chunksize": CHUNK_SIZE, "regions": [r.todict() for r in index]}, f)
+    return Snapshot(path)
+
+
+def iterchanged(old, new, address):
+    # xor of the two chunks as big ints, changed bytes are the non zero runs
+    xor = (int.from_bytes(old, "big") ^ int.from_bytes(new, "big")).to_bytes(len(old), "big")
+    for m in CHANGED.finditer(xor):
+        yield address + m.start(), m.end() - m.start()
+
+
+def merge(ranges, gap=0):
+    current = None
+    for address, length in ranges:
+        if current and address <= current[0] + current[1] + gap:
+            current[1] = address + length - current[0]
+            continue
+        if current:
+            yield tuple(current)
+        current = [address, length]
+    if current:
+        yield tuple(current)
+
+
+def iterregiondiff(old, new, name, gap=0):
+    oldregion = old.regions[name]
+    newregion = new.regions[name]
+    oldview = old.view(name)
+    newview = new.view(name)
+    size = min(oldregion.size, newregion.size)
+    # the chunk hashes of snapshots dumped with different chunk sizes do not line up, those are
+    # compared by their bytes only
+    chunksize = old.chunksize if old.chunksize and old.chunksize == new.chunksize else None
+    step = chunksize or CHUNK_SIZE
+
+    def iterdirty():
+        for index, start in enumerate(range(0, size, step)):
+            end = min(start + step, size)
+            if chunksize and end - start == chunksize and index < len(oldregion.hashes) and index < len(newregion.hashes) \
+                    and oldregion.hashes[index] == newregion.hashes[index]:
+                continue
+            if oldview[start:end] == newview[start:end]:
+                continue
+            yield from iterchanged(oldview[start:end], newview[start:end], newregion.address + start)
+        if newregion.size != oldregion.size:
+            yield newregion.address + size, abs(newregion.size - oldregion.size)
+
+    return merge(iterdirty(), gap)
+
+
+def diff(old, new, gap=0):
+    # returns [(region name, address, length)] of the changed ranges of the regions common in both snapshots
+    changes = []
+    for name in new.regions:
+        if name not in old.regions or old.regions[name].address != new.regions[name].address:
+            continue
+        for address, length in iterregiondiff(old, new, name, gap):
+            changes.append((name, address, length))
+    return changes
+
+
+def report(changes):
+    return "\n".join(f"{name} 0x{address:08x} +0x{length:x}" for name, address, length in changes)
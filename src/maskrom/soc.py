@@ -14,23 +14,38 @@
  You should have received a copy of the GNU General Public License
  along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
+import hashlib
+import json
+import mmap
+import os
+import tempfile
+import urllib.request
+
 from maskrom import defs
+from maskrom import device
 
 LEGACY_COMMIT = "d24503d2bd236780d36bff9243b1a4557d38ec30"
 LATEST_COMMIT = "7c35e21a8529b3758d1f051d1a5dc62aae934b2b"
 
 
 class RkBin:
-    def __init__(self, *variants):
+    def __init__(self, **variants):
+        # {variant: (commit, path)}
         self.variants = variants
 
+    def select(self, variant=None):
+        if not self.variants:
+            raise defs.MaskromException("No rkbin variants available")
+        if variant is None:
+            variant = next(iter(self.variants))
+        if variant not in self.variants:
+            raise defs.MaskromException(f"Unknown rkbin variant {variant}, available: {', '.join(self.variants)}")
+        return self.variants[variant]
+
 
 class RkBinOfficial(RkBin):
-    def __init__(self, commit, *variants):
-        _variants = {}
-        for k, v in variants.items():
-            _variants[k] = f"{defs.RKBINREPO}/raw/{commit}/{v}"
-        super().__init__(**_variants)
+    def __init__(self, commit, **variants):
+        super().__init__(**{k: (commit, v) for k, v in variants.items()})
 
 
 def rkbin(commit, path):
@@ -38,19 +53,21 @@ def rkbin(commit, path):
 
 
 class RockchipSoc:
+    # name is one of defs.DEVICE_*, the pid is looked up in defs.MASKROM_PRODUCT_IDS
     vid = defs.RK_VENDOR_ID
     pid = None
-    sram = {}
-    dram = {}
+    sram = None
+    dram = None
     tag = None
+    name = None
 
 
 class Rk1106(RockchipSoc):
-    pid = 0x110c
+    name = defs.DEVICE_RK1106
 
 
 class Rk1808(RockchipSoc):
-    pid = 0x1808
+    name = defs.DEVICE_RK1808
     sram = RkBinOfficial(LATEST_COMMIT, ddr_933="bin/rk1x/rk1808_ddr_933MHz_v1.06.bin")
     dram = RkBinOfficial(LATEST_COMMIT,
                          usbplug="bin/rk1x/rk1808_usbplug_v1.05.bin",
@@ -59,28 +76,24 @@ class Rk1808(RockchipSoc):
 
 # RK28 Series
 class Rk2818(RockchipSoc):
-    pid = 0x281a
+    name = defs.DEVICE_RK2818
     tag = "281X"
-    name = "rk2818"
 
 
 # RK29 Series
 class Rk2918(RockchipSoc):
-    pid = 0x290a
-    name = "rk2918"
+    name = defs.DEVICE_RK2918
 
 
 class Rk2926_Rk2928(RockchipSoc):
-    pid = 0x292a
-    rag = "292X"
-    name = "rk2926/8"
+    name = defs.DEVICE_RK2928
+    tag = "292X"
 
 
 # RK30 Series
 class Rk3026_Rk3028(RockchipSoc):
-    pid = 0x292c
+    name = defs.DEVICE_RK3026
     tag = "292X"
-    name = "rk3026/8"
     sram = RkBinOfficial(LEGACY_COMMIT,
                          lpddr2_ddr3="30_LPDDR2_300MHz_DDR3_300MHz_20130517.bin",
                          ddr3="RK3036_DDR3_400M_V1.06.bin")
@@ -88,39 +101,33 @@ class Rk3026_Rk3028(RockchipSoc):
 
 
 class Rk3032(Rk3026_Rk3028):
-    # what is pid?
-    pid = None
-    name = "rk3032"
+    name = defs.DEVICE_RK3032
     dram = RkBinOfficial(LATEST_COMMIT,
                          usbplug="bin/rk30/rk3032_usbplug_v2.61.bin",
                          usbplug_slc="bin/rk30/rk3032_usbplug_slc_v2.63.bin")
 
 
 class Rk3036(Rk3026_Rk3028):
-    pid = 0x301a
+    name = defs.DEVICE_RK3036
     tag = "301A"
-    name = "rk3036"
     dram = RkBinOfficial(LATEST_COMMIT,
                          usbplug="rk303x_usbplug_v2.57.bin",
                          usbplug_slc="rk303x_usbplug_slc_v2.65.bin")
 
 
 class Rk3066(Rk3026_Rk3028):
-    pid = 0x300a
-    name = "rk3066"
+    name = defs.DEVICE_RK3066
     tag = "300A"
 
 
 class Rk3066b(Rk3026_Rk3028):
-    pid = 0x310a
-    name = "rk3066b"
+    name = defs.DEVICE_RK3066B
     tag = "310A"
 
 
 # RK31 Series
 class Rk3126(RockchipSoc):
-    pid = 0x310d
-    name = "rk3126"
+    name = defs.DEVICE_RK3126
     tag = "310D"
     sram = RkBinOfficial(LATEST_COMMIT, ddr="bin/rk31/rk3126_ddr_300MHz_v2.09.bin")
     dram = RkBinOfficial(LATEST_COMMIT,
@@ -129,8 +136,7 @@ class Rk3126(RockchipSoc):
 
 
 class Rk3128(RockchipSoc):
-    pid = 0x310c
-    name = "rk3128"
+    name = defs.DEVICE_RK312X
     tag = "310C"
     sram = RkBinOfficial(LATEST_COMMIT,
                          ddr="bin/rk31/rk3128_ddr_300MHz_v2.12.bin",
@@ -142,16 +148,108 @@ class Rk3128(RockchipSoc):
 
 
 class Rk3168(RockchipSoc):
-    pid = 0x300b
-    name = "rk3168"
+    name = defs.DEVICE_RK3168
     tag = "300B"
     sram = RkBinOfficial(LEGACY_COMMIT, lpddr2_ddr3="3168_LPDDR2_300MHz_DDR3_300MHz_20130517.bin")
     dram = RkBinOfficial(LEGACY_COMMIT, usbplug="rk30usbplug.bin")
 
 
 class Rk3188(Rk3168):
-    pid = 0x310b
-    name = "rk3188"
+    name = defs.DEVICE_RK3188
     tag = "310B"
     sram = RkBinOfficial(LATEST_COMMIT, ddr="bin/rk31/bin/rk31/rk3188_ddr_v2.00.bin")
     dram = RkBinOfficial(LATEST_COMMIT, usbplug="bin/rk31/bin/rk31/rk3188_usbplug_v2.00.bin")
+
+
+def _itersocs(cls=RockchipSoc):
+    for soc in cls.__subclasses__():
+        yield soc
+        yield from _itersocs(soc)
+
+
+PIDS_BY_NAME = {name: pid for pid, name in defs.MASKROM_PRODUCT_IDS.items()}
+SOCS_BY_PID = {}
+SOCS_BY_TAG = {}
+for _soc in _itersocs():
+    # set on every class, so that a subclass does not inherit the pid of its parent
+    _soc.pid = PIDS_BY_NAME.get(_soc.name)
+    if _soc.pid:
+        SOCS_BY_PID.setdefault(_soc.pid, _soc)
+    if _soc.tag:
+        SOCS_BY_TAG.setdefault(_soc.tag, []).append(_soc)
+
+
+def lookup(pid=None, tag=None):
+    # pid comes from the usb descriptor and costs no request, chip info tag is only needed for unknown pids
+    if pid in SOCS_BY_PID:
+        return SOCS_BY_PID[pid]
+    socs = SOCS_BY_TAG.get(tag, [])
+    if len(socs) == 1:
+        return socs[0]
+    raise defs.MaskromException(f"Unknown or ambiguous soc pid={pid} tag={tag}")
+
+
+def resolve(dev):
+    pid = dev.usb.dev.idProduct
+    if pid in SOCS_BY_PID:
+        return SOCS_BY_PID[pid]
+    chipinfo = dev.read_chip_info()
+    return lookup(pid, getattr(chipinfo, "tag", None))
+
+
+class Mirror(defs.Printable):
+    # local content addressed store of rkbin blobs, index maps commit/path to the sha256 of the blob
+    def __init__(self, root):
+        self.root = root
+        self._indexpath = os.path.join(root, "index.json")
+        self._index = {}
+        if os.path.exists(self._indexpath):
+            with open(self._indexpath) as f:
+                self._index = json.load(f)
+
+    def blobpath(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:])
+
+    def add(self, commit, path, data):
+        digest = hashlib.sha256(data).hexdigest()
+        blobpath = self.blobpath(digest)
+        if not os.path.exists(blobpath):
+            os.makedirs(os.path.dirname(blobpath), exist_ok=True)
+            fd, tmppath = tempfile.mkstemp(dir=os.path.dirname(blobpath))
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmppath, blobpath)
+        self._index[f"{commit}/{path}"] = digest
+        with open(self._indexpath, "w") as f:
+            json.dump(self._index, f, indent=1)
+        return digest
+
+    def fetch(self, commit, path):
+        # populates the mirror from the network, autoboot never calls this
+        with urllib.request.urlopen(rkbin(commit, path)) as f:
+            return self.add(commit, path, f.read())
+
+    def get(self, commit, path):
+        key = f"{commit}/{path}"
+        if key not in self._index:
+            raise defs.MaskromException(f"{key} is not in the mirror {self.root}")
+        with open(self.blobpath(self._index[key]), "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if hashlib.sha256(data).hexdigest() != self._index[key]:
+            raise defs.VerifyException(f"Mirrored blob of {key} is corrupted")
+        return data
+
+
+def autoboot(mirror, offset=0, sram=None, dram=None, wait=True):
+    # detects the soc, loads its ddr init and usbplug from the mirror, returns the usbplug device
+    if not isinstance(mirror, Mirror):
+        mirror = Mirror(mirror)
+    dev = device.Device(offset)
+    soc = resolve(dev)
+    if not soc.sram or not soc.dram:
+        raise defs.MaskromException(f"No loaders known for {soc.name}")
+    dev.load_sram(mirror.get(*soc.sram.select(sram)))
+    dev.load_dram(mirror.get(*soc.dram.select(dram)))
+    if wait:
+        return dev.wait_for_reenumeration()
+    return dev
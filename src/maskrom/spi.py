@@ -0,0 +1,86 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import hashlib
+
+from maskrom import defs
+from maskrom import request
+from maskrom import response
+
+# smallest erasable unit of spi nor flashes
+SPI_SECTOR_SIZE = 4096
+SPI_SECTOR_LBA = int(SPI_SECTOR_SIZE / defs.BLOCK_SIZE)
+SPI_ERASED = 0xff
+
+
+def dump(device, f, offset, length, hashfunc=hashlib.sha256):
+    m = hashfunc()
+    for resp in defs.Prefetch(device.iter_spi(offset, length)):
+        buffer = response.checkbuffer(resp)
+        m.update(buffer)
+        f.write(buffer)
+    return m.digest()
+
+
+def digest(device, offset, length, hashfunc=hashlib.sha256):
+    m = hashfunc()
+    for resp in defs.Prefetch(device.iter_spi(offset, length)):
+        m.update(response.checkbuffer(resp))
+    return m.digest()
+
+
+def iterchanged(offset, new, old):
+    # yields the (lba, count) ranges of changed sectors
+    for index in range(0, len(new), SPI_SECTOR_SIZE):
+        if new[index:index + SPI_SECTOR_SIZE] != old[index:index + SPI_SECTOR_SIZE]:
+            sectorlen = min(SPI_SECTOR_SIZE, len(new) - index)
+            yield offset + int(index / defs.BLOCK_SIZE), int(sectorlen / defs.BLOCK_SIZE)
+
+
+def program(device, offset, source, length=None, verify=True, hashfunc=hashlib.sha256):
+    reader = defs.Reader(source)
+    if length is None:
+        length = defs.blockcount(reader.size)
+    m = hashfunc()
+    written = 0
+    total = 0
+    chunks = defs.Prefetch(reader.iterchunks(defs.USB_MAX_TRANSFER_SIZE))
+    try:
+        # the batches bound the write to length, a short source ends it earlier
+        for (chunkoffset, count), buffer in zip(defs.iterbatch(length, defs.USB_MAX_BLOCK_COUNT, offset), chunks):
+            buffer = bytes(buffer[:count * defs.BLOCK_SIZE])
+            count = defs.blockcount(len(buffer))
+            buffer += bytes([SPI_ERASED]) * (count * defs.BLOCK_SIZE - len(buffer))
+            m.update(buffer)
+            total += count
+            old = response.checkbuffer(device.usb.response(request.read_spi_flash, response.Buffer, chunkoffset,
+                                                           count))
+            old = memoryview(old).cast("B")
+            new = memoryview(buffer)
+            for lba, changed in defs.itercoalesce(iterchanged(chunkoffset, new, old)):
+                start = (lba - chunkoffset) * defs.BLOCK_SIZE
+                data = new[start:start + changed * defs.BLOCK_SIZE]
+                response.checkstatus(device.usb.response(request.write_spi_flash, response.Status, lba, changed,
+                                                         buffer=data))
+                written += changed
+    finally:
+        chunks.close()
+    if verify:
+        expected = m.digest()
+        readback = digest(device, offset, total, hashfunc)
+        if readback != expected:
+            raise defs.VerifyException(f"Spi flash hash is {readback.hex()} but expected {expected.hex()}")
+    return written
@@ -17,6 +17,7 @@
 import ctypes
 import errno
 import itertools
+import time
 import usb.util
 
 from maskrom import crc
@@ -32,10 +33,63 @@ def iterdevices():
             yield dev
 
 
+def portpath(dev):
+    try:
+        return dev.bus, tuple(dev.port_numbers or ())
+    except NotImplementedError:
+        return dev.bus, ()
+
+
+def superspeedmatch(dev, finder=iterdevices):
+    # after a switch to usb3 the device shows up on the superspeed companion bus of the
+    # host controller, so it is matched as a new device of the same id on a superspeed link
+    known = {(candidate.bus, candidate.address) for candidate in finder()}
+
+    def match(candidate):
+        return ((candidate.bus, candidate.address) not in known
+                and (candidate.idVendor, candidate.idProduct) == (dev.idVendor, dev.idProduct)
+                and (candidate.speed or 0) >= defs.USB_SPEED_SUPER)
+    return match
+
+
+def wait_for_reenumeration(dev, timeout=defs.REENUMERATION_TIMEOUT, interval=defs.POLL_INTERVAL,
+                           match=None, finder=iterdevices):
+    # returns the device that shows up on the same physical port with a new address, or the
+    # first device accepted by match
+    path = portpath(dev)
+    address = dev.address
+    if match is None:
+        def match(candidate):
+            return candidate.address != address and portpath(candidate) == path
+    deadline = time.monotonic() + timeout / 1000
+    while True:
+        for candidate in finder():
+            if match(candidate):
+                return candidate
+        if time.monotonic() > deadline:
+            raise defs.CommandException(f"Device on port {path} did not re-enumerate in {timeout}ms",
+                                        None, errno.ETIMEDOUT)
+        time.sleep(interval)
+
+
+def settle(opener, timeout=defs.REENUMERATION_TIMEOUT, interval=defs.POLL_INTERVAL):
+    # a device which has just enumerated may fail its configuration requests until it settles,
+    # so opener is called again on usb errors until the timeout
+    deadline = time.monotonic() + timeout / 1000
+    while True:
+        try:
+            return opener()
+        except usb.core.USBError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(interval)
+
+
 class Usb:
-    def __init__(self, offset=0, timeout=defs.DEFAULT_TIMEOUT):
+    def __init__(self, offset=0, timeout=defs.DEFAULT_TIMEOUT, dev=None, finder=iterdevices):
         self.timeout = timeout
-        self.dev = list(iterdevices())[offset]
+        self.finder = finder
+        self.dev = dev if dev is not None else list(finder())[offset]
         cfg = self.dev.get_active_configuration()
         intf = cfg[(0, 0)]
         self.ep_write = usb.util.find_descriptor(intf, custom_match=self.find_ep_out)
@@ -70,9 +124,9 @@ class Usb:
     def readbulk(self):
         pass
 
-    def parseresponse(self, req, buffer=None):
+    def parseresponse(self, req, buffer=None, timeout=None):
         if not buffer:
-            buffer = self.read(ctypes.sizeof(response.c_response))
+            buffer = self.read(ctypes.sizeof(response.c_response), timeout)
         resp = response.c_response.from_buffer(buffer)
         if not resp.sign == response.SIGNATURE:
             raise defs.CommandException(f"Received wrong response signature {resp.sign}, expected {response.SIGNATURE}",
@@ -84,10 +138,10 @@ class Usb:
                                         errno.EIO)
         return resp
 
-    def requestin(self, req):
+    def requestin(self, req, timeout=None):
         bulk_buffer = None
         if req.length:
-            bulk_buffer = self.read(req.length)
+            bulk_buffer = self.read(req.length, timeout)
             # in case of buggy implementations spit premature response
             try:
                 if not len(bulk_buffer) < ctypes.sizeof(response.c_response):
@@ -95,28 +149,30 @@ class Usb:
                     return resp
             except defs.CommandException as _ue:
                 pass
-        resp = self.parseresponse(req)
+        resp = self.parseresponse(req, timeout=timeout)
         resp.buffer = bulk_buffer
         return resp
 
-    def requestout(self, req):
-        self.write(req.buffer)
-        resp = self.parseresponse(self.read(ctypes.sizeof(response.c_response)), req)
-        return resp
+    def requestout(self, req, timeout=None):
+        if req.length:
+            self.write(req.buffer, timeout)
+        return self.parseresponse(req, timeout=timeout)
 
-    def request(self, req):
+    def request(self, req, timeout=None):
         req_buffer = bytes(req)
         self.write(req_buffer)
         if req.flag == request.DIRECTION_IN:
-            return self.requestin(req)
+            return self.requestin(req, timeout)
         elif req.flag == request.DIRECTION_OUT:
-            return self.requestout(req)
+            return self.requestout(req, timeout)
         else:
             raise defs.CommandException(f"Unknown request flag {req.op.flag}")
 
-    def response(self, request_ob, response_ob, *args, **kwargs):
+    def response(self, request_ob, response_ob, *args, buffer=None, timeout=None, **kwargs):
         try:
-            return response_ob(self.request(request_ob(*args, **kwargs)))
+            req = request_ob(*args, **kwargs)
+            req.buffer = buffer
+            return response_ob(self.request(req, timeout))
         except defs.CommandException as ue:
             return response.Unsupported(str(ue))
 
@@ -129,7 +185,10 @@ class Usb:
 
     def loadfiletoram(self, fpath, sram=True, encrypt=True):
         with open(fpath, "rb") as f:
-            buffer = f.read()
+            return self.loadtoram(f.read(), sram, encrypt)
+
+    def loadtoram(self, buffer, sram=True, encrypt=True):
+        buffer = bytes(buffer)
         # transfer is finished when last unaligned block is sent
         # if file-size + 2 byte crc is block aligned, send an extra 0x00 padding to
         # un-align the total transfer size and finish the transfer
@@ -0,0 +1,211 @@
+"""
+ Copyright (C) 2024 boogie
+
+ This program is free software: you can redistribute it and/or modify
+ it under the terms of the GNU General Public License as published by
+ the Free Software Foundation, either version 3 of the License, or
+ (at your option) any later version.
+
+ This program is distributed in the hope that it will be useful,
+ but WITHOUT ANY WARRANTY; without even the implied warranty of
+ MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ GNU General Public License for more details.
+
+ You should have received a copy of the GNU General Public License
+ along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+import concurrent.futures
+import hashlib
+import json
+import mmap
+import os
+
+from maskrom import defs
+from maskrom import response
+
+CHUNK_SIZE = 1024 * 1024
+TREE_SUFFIX = ".merkle"
+MAX_WORKERS = os.cpu_count() or 4
+
+
+def hashleaf(buffer):
+    # leaves and nodes are domain separated
+    m = hashlib.sha256(b"\x00")
+    m.update(buffer)
+    return m.digest()
+
+
+def hashnode(left, right):
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+
+class MerkleTree(defs.Printable):
+    def __init__(self, leaves, chunksize, size):
+        self.chunksize = chunksize
+        self.size = defs.PrettyInt(size)
+        # levels[0] are the leaves, levels[-1] is the root, odd nodes are promoted as is
+        self._levels = [list(leaves)]
+        while len(self._levels[-1]) > 1:
+            level = self._levels[-1]
+            self._levels.append([hashnode(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                                 for i in range(0, len(level), 2)])
+
+    @property
+    def leaves(self):
+        return self._levels[0]
+
+    @property
+    def root(self):
+        return self._levels[-1][0] if self.leaves else hashleaf(b"")
+
+    def mismatches(self, other):
+        # descends only into differing subtrees, returns the indices of differing leaves
+        if len(self.leaves) != len(other.leaves):
+            raise defs.VerifyException(f"Trees have {len(self.leaves)} and {len(other.leaves)} leaves")
+        if not self.leaves:
+            return []
+        nodes = [0]
+        for depth in range(len(self._levels) - 1, -1, -1):
+            mine = self._levels[depth]
+            theirs = other._levels[depth]
+            nodes = [node for node in nodes if mine[node] != theirs[node]]
+            if depth:
+                below = len(self._levels[depth - 1])
+                nodes = [child for node in nodes for child in (2 * node, 2 * node + 1) if child < below]
+        return nodes
+
+    def ranges(self, leaves, offset=0):
+        # (lba, count) ranges of the given leaves on the device, coalesced
+        lbaperchunk = self.chunksize // defs.BLOCK_SIZE
+        return list(defs.itercoalesce((offset + leaf * lbaperchunk,
+                                       defs.blockcount(min(self.chunksize, self.size - leaf * self.chunksize)))
+                                      for leaf in sorted(leaves)))
+
+    def todict(self):
+        return {"chunksize": self.chunksize, "size": int(self.size), "leaves": [leaf.hex() for leaf in self.leaves]}
+
+
+def hashleaves(view, chunksize=CHUNK_SIZE, workers=MAX_WORKERS):
+    # hashlib releases the gil for large buffers, so the chunks are hashed in parallel
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(hashleaf, (view[start:start + chunksize] for start in range(0, len(view), chunksize))))
+
+
+class Image:
+    # a read only view of a path or a bytes like object
+    def __init__(self, source):
+        self.path = None
+        self._file = None
+        self._mmap = None
+        if isinstance(source, (str, os.PathLike)):
+            self.path = source
+            self._file = open(source, "rb")
+            size = os.fstat(self._file.fileno()).st_size
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            source = self._mmap
+        self.view = memoryview(source).cast("B")
+
+    def close(self):
+        self.view.release()
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        if self._file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _cachekey(path, chunksize):
+    st = os.stat(path)
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "chunksize": chunksize}
+
+
+def tree(image, chunksize=CHUNK_SIZE, workers=MAX_WORKERS):
+    # the tree of an image, images given by path are cached in <path>.merkle while unmodified
+    if image.path:
+        key = _cachekey(image.path, chunksize)
+        try:
+            with open(image.path + TREE_SUFFIX) as f:
+                cached = json.load(f)
+            if cached["key"] == key:
+                return MerkleTree([bytes.fromhex(leaf) for leaf in cached["leaves"]], chunksize, key["size"])
+        except (OSError, ValueError, KeyError):
+            pass
+    result = MerkleTree(hashleaves(image.view, chunksize, workers), chunksize, len(image.view))
+    if image.path:
+        try:
+            with open(image.path + TREE_SUFFIX, "w") as f:
+                json.dump(dict(result.todict(), key=key), f)
+        except OSError:
+            # read only image directories only lose the cache
+            pass
+    return result
+
+
+def readleaves(device, offset, size, leaves, chunksize=CHUNK_SIZE, workers=MAX_WORKERS):
+    # reads the given leaves back with a pipelined iter_lba per contiguous run, returns {leaf: digest}
+    lbaperchunk = chunksize // defs.BLOCK_SIZE
+    futures = {}
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        for first, count in defs.itercoalesce((leaf, 1) for leaf in sorted(leaves)):
+            remaining = min((first + count) * chunksize, size) - first * chunksize
+            pending = bytearray()
+            leaf = first
+            for resp in defs.Prefetch(device.iter_lba(offset + first * lbaperchunk, defs.blockcount(remaining)),
+                                      device.queuedepth):
+                pending += response.checkbuffer(resp)
+                # the padding of the last block is not part of the image
+                while remaining and len(pending) >= min(chunksize, remaining):
+                    length = min(chunksize, remaining)
+                    futures[leaf] = pool.submit(hashleaf, bytes(pending[:length]))
+                    del pending[:length]
+                    remaining -= length
+                    leaf += 1
+        return {leaf: future.result() for leaf, future in futures.items()}
+
+
+def verify(device, image, offset=0, chunksize=CHUNK_SIZE, workers=MAX_WORKERS, leaves=None):
+    # returns the mismatching (lba, count) ranges, leaves limits the read back to those leaves
+    with Image(image) as img:
+        expected = tree(img, chunksize, workers)
+    if leaves is None:
+        leaves = range(len(expected.leaves))
+    digests = readleaves(device, offset, expected.size, leaves, chunksize, workers)
+    if len(digests) == len(expected.leaves):
+        actual = MerkleTree([digests[leaf] for leaf in range(len(digests))], chunksize, expected.size)
+        bad = expected.mismatches(actual)
+    else:
+        bad = [leaf for leaf, digest in digests.items() if digest != expected.leaves[leaf]]
+    return expected.ranges(bad, offset)
+
+
+def rewrite(device, image, ranges, offset=0, badblocks=None, remap=False):
+    # writes only the given (lba, count) ranges of the image
+    written = 0
+    with Image(image) as img:
+        for lba, count in ranges:
+            start = (lba - offset) * defs.BLOCK_SIZE
+            written += device.write_lba(lba, img.view[start:start + count * defs.BLOCK_SIZE],
+                                        badblocks=badblocks, remap=remap)
+    return written
+
+
+def repair(device, image, offset=0, chunksize=CHUNK_SIZE, workers=MAX_WORKERS, retries=2):
+    # verifies, rewrites the mismatching ranges and verifies only those again, returns the rewritten ranges
+    ranges = verify(device, image, offset, chunksize, workers)
+    repaired = list(ranges)
+    lbaperchunk = chunksize // defs.BLOCK_SIZE
+    for _ in range(retries):
+        if not ranges:
+            return repaired
+        rewrite(device, image, ranges, offset)
+        leaves = {leaf for lba, count in ranges
+                  for leaf in range((lba - offset) // lbaperchunk, -(-(lba - offset + count) // lbaperchunk))}
+        ranges = verify(device, image, offset, chunksize, workers, leaves)
+    if ranges:
+        raise defs.VerifyException(f"Ranges still differ after {retries} rewrites: {ranges}")
+    return repaired